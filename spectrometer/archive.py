@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+'''
+Append only archive for continuous acquisitions.
+
+An archive is a directory holding compressed chunks of spectra and an index:
+
+    archive/
+        index.json          chunk list with time range and record count
+        chunk_000000.npz    timestamps, spectra, metadata (and frames)
+        chunk_000001.npz
+        ...
+
+Records are collected in a preallocated in-memory chunk and written as one
+compressed file when the chunk is full (or on flush/close).
+Chunk files and the index are written to a temporary file and moved into
+place, so readers in other processes never see partial files while the
+acquisition keeps writing. There must only be one writer per archive.
+
+'''
+import bisect
+import json
+import os
+import os.path
+import time
+
+import numpy as np
+
+
+class Archive(object):
+    '''A chunked time series archive of 1d spectra.
+
+    :params path: The archive directory
+    :type path: str
+    :params mode: r (read only) or a (append, creates the archive if needed)
+    :type mode: str
+    :params chunk_size: Number of records per chunk
+    :type chunk_size: int
+    :params store_frames: If true every record also holds a 2d frame (e.g. the roi)
+    :type store_frames: bool
+    :params flush_interval: Seconds after which a partial chunk is written,
+        limits how far readers lag behind the writer (None: only full chunks)
+    :type flush_interval: float
+
+    '''
+
+    def __init__(self, path, mode='a', chunk_size=256, store_frames=False, flush_interval=None):
+        assert mode in ('r', 'a'), 'mode must be r or a.'
+        assert isinstance(chunk_size, int) and chunk_size > 0, 'chunk_size must be a positive int.'
+
+        self.path = path
+        self.mode = mode
+        self.chunk_size = chunk_size
+        self.store_frames = store_frames
+        self.flush_interval = flush_interval
+        self.chunks = []
+
+        if mode == 'r':
+            assert os.path.isfile(self._index_file()), 'Archive not found: {}'.format(path)
+        elif not os.path.isdir(path):
+            os.makedirs(path)
+        if os.path.isfile(self._index_file()):
+            self._read_index()
+
+        self._buffer = None
+        self._frames = None
+        self._timestamps = np.empty(chunk_size, dtype=np.float64)
+        self._metadata = []
+        self._count = 0
+        self._last_flush = time.time()
+
+    def __len__(self):
+        return sum(chunk['count'] for chunk in self.chunks) + self._count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def append(self, spectrum1d, timestamp=None, frame=None, **metadata):
+        '''Appends a record.
+
+        :params spectrum1d: The spectrum
+        :type spectrum1d: numpy.ndarray
+        :params timestamp: Seconds since the epoch (default: now)
+        :type timestamp: float
+        :params frame: The 2d frame (only if the archive stores frames)
+        :type frame: numpy.ndarray
+        :params metadata: Additional json serializable values (name, kind, ...)
+        :returns: None
+        :raises: AssertionError
+
+        '''
+        assert self.mode == 'a', 'Archive is opened read only.'
+        assert (frame is not None) == self.store_frames, \
+            'frame must be given if and only if the archive stores frames.'
+
+        if timestamp is None:
+            timestamp = time.time()
+        assert timestamp >= self._last_timestamp(), 'timestamps must not decrease.'
+
+        if self._buffer is None:
+            self._allocate(np.asarray(spectrum1d), frame)
+
+        self._buffer[self._count] = spectrum1d
+        if self.store_frames:
+            self._frames[self._count] = frame
+        self._timestamps[self._count] = timestamp
+        self._metadata.append(json.dumps(metadata))
+        self._count += 1
+
+        if self._count == self.chunk_size:
+            self.flush()
+        elif self.flush_interval is not None and time.time() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def append_spectrum(self, spec, timestamp=None, frame=None):
+        '''Appends a processed spectrum.Spectrum.
+
+        :params spec: The processed spectrum
+        :type spec: spectrum.Spectrum
+        :returns: None
+        :raises: AssertionError
+
+        '''
+        assert hasattr(spec, 'spectrum1d'), 'Spectrum must be processed before archiving.'
+
+        self.append(spec.spectrum1d, timestamp, frame,
+                    name=spec.name, kind=spec.kind, num_frames=spec.num_frames)
+
+    def flush(self):
+        '''Writes the buffered records as a new chunk.
+
+        :returns: None
+
+        '''
+        self._last_flush = time.time()
+        if self._count == 0:
+            return
+
+        count = self._count
+        arrays = {
+            'timestamps': self._timestamps[:count],
+            'spectra': self._buffer[:count],
+            'metadata': np.array(self._metadata),
+        }
+        if self.store_frames:
+            arrays['frames'] = self._frames[:count]
+
+        filename = 'chunk_{:06d}.npz'.format(len(self.chunks))
+        tmp = os.path.join(self.path, '.' + filename)
+        with open(tmp, 'wb') as outf:
+            np.savez_compressed(outf, **arrays)
+        os.replace(tmp, os.path.join(self.path, filename))
+
+        self.chunks.append({
+            'file': filename,
+            'start': float(self._timestamps[0]),
+            'end': float(self._timestamps[count - 1]),
+            'count': count,
+        })
+        self._write_index()
+
+        self._metadata = []
+        self._count = 0
+
+    def close(self):
+        '''Flushes the buffered records.
+
+        '''
+        if self.mode == 'a':
+            self.flush()
+
+    def query(self, start=None, end=None):
+        '''Returns all records with start <= timestamp <= end.
+
+        Only chunks overlapping the time range are read. The index is reread
+        on every query, so readers see chunks written in the meantime.
+
+        :params start: Start time in seconds since the epoch (None: first record)
+        :type start: float
+        :params end: End time in seconds since the epoch (None: last record)
+        :type end: float
+        :returns: timestamps (ndarray), spectra (ndarray), metadata (list of dicts)
+            and frames (ndarray, only if the archive stores frames)
+
+        '''
+        if self.mode == 'r':
+            self._read_index()
+
+        start = -np.inf if start is None else start
+        end = np.inf if end is None else end
+
+        # Chunks are in time order, skip all chunks ending before start
+        ends = [chunk['end'] for chunk in self.chunks]
+        first = bisect.bisect_left(ends, start)
+
+        parts = []
+        for chunk in self.chunks[first:]:
+            if chunk['start'] > end:
+                break
+            with np.load(os.path.join(self.path, chunk['file'])) as npz:
+                parts.append(self._select(dict(npz), start, end))
+        if self._count:
+            buffered = {
+                'timestamps': self._timestamps[:self._count],
+                'spectra': self._buffer[:self._count],
+                'metadata': np.array(self._metadata),
+            }
+            if self.store_frames:
+                buffered['frames'] = self._frames[:self._count]
+            parts.append(self._select(buffered, start, end))
+
+        if not parts:
+            results = [np.empty(0), np.empty((0, 0)), []]
+            if self.store_frames:
+                results.append(np.empty((0, 0, 0)))
+            return tuple(results)
+
+        keys = ['timestamps', 'spectra', 'metadata']
+        if self.store_frames:
+            keys.append('frames')
+        results = [np.concatenate([part[key] for part in parts]) for key in keys]
+        results[2] = [json.loads(item) for item in results[2]]
+        return tuple(results)
+
+    def _select(self, arrays, start, end):
+        '''Returns the records of arrays in the time range.
+
+        '''
+        timestamps = arrays['timestamps']
+        lo = np.searchsorted(timestamps, start, side='left')
+        hi = np.searchsorted(timestamps, end, side='right')
+        return {key: value[lo:hi] for key, value in arrays.items()}
+
+    def _allocate(self, spectrum1d, frame):
+        '''Allocates the chunk buffers from the first record.
+
+        '''
+        assert spectrum1d.ndim == 1, 'spectrum1d must be one dimensional.'
+
+        self._buffer = np.empty((self.chunk_size,) + spectrum1d.shape, dtype=spectrum1d.dtype)
+        if self.store_frames:
+            frame = np.asarray(frame)
+            self._frames = np.empty((self.chunk_size,) + frame.shape, dtype=frame.dtype)
+
+    def _last_timestamp(self):
+        if self._count:
+            return self._timestamps[self._count - 1]
+        if self.chunks:
+            return self.chunks[-1]['end']
+        return -np.inf
+
+    def _index_file(self):
+        return os.path.join(self.path, 'index.json')
+
+    def _read_index(self):
+        with open(self._index_file()) as inf:
+            index = json.load(inf)
+        self.chunks = index['chunks']
+        self.store_frames = index['store_frames']
+
+    def _write_index(self):
+        tmp = os.path.join(self.path, '.index.json')
+        with open(tmp, 'w') as outf:
+            json.dump({'store_frames': self.store_frames, 'chunks': self.chunks}, outf)
+        os.replace(tmp, self._index_file())
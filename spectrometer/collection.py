@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+'''
+Columnar in-memory collection of processed spectra.
+
+Spectrum objects carry the full frame data and its backup copy, which
+limits a session to a few hundred spectra. A SpectrumCollection only
+keeps the spectrum1d of every spectrum as a row of one contiguous
+(N, W) array plus one array per metadata column (name, kind, num_frames,
+timestamp), so 100k spectra of 1920 columns need about 770 MB in float32.
+
+Filtering, slicing and aggregation work on whole columns:
+
+    collection = SpectrumCollection(1920)
+    collection.append_spectrum(spectrum)
+    recent = collection.filter(kind='spectrum', start=time.time() - 3600)
+    mean = recent.mean()
+
+'''
+import collections
+
+import numpy as np
+
+
+Record = collections.namedtuple('Record', ['spectrum1d', 'name', 'kind', 'num_frames', 'timestamp'])
+
+COLUMNS = ('name', 'kind', 'num_frames', 'timestamp')
+
+
+class SpectrumCollection(object):
+    '''A growable table of spectra.
+
+    The arrays are preallocated and grow by doubling, so appending is
+    amortized O(W). Indexing with an int returns a Record, with a slice,
+    index array or boolean mask a new collection.
+
+    :params width: The length of the spectra
+    :type width: int
+    :params dtype: The dtype of the spectra
+    :type dtype: numpy.dtype
+    :params capacity: Number of preallocated rows
+    :type capacity: int
+
+    '''
+
+    def __init__(self, width, dtype=np.float32, capacity=1024):
+        assert isinstance(width, int) and width > 0, 'width must be a positive int.'
+
+        capacity = max(int(capacity), 1)
+        self.width = width
+        self.dtype = np.dtype(dtype)
+        self.count = 0
+        self._spectra = np.zeros((capacity, width), dtype=self.dtype)
+        self._name = np.empty(capacity, dtype=object)
+        self._kind = np.empty(capacity, dtype=object)
+        self._num_frames = np.full(capacity, -1, dtype=np.int64)
+        self._timestamp = np.full(capacity, np.nan, dtype=np.float64)
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self[i]
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            if index < 0:
+                index += self.count
+            if not 0 <= index < self.count:
+                raise IndexError('Index {} out of range.'.format(index))
+            return Record(self._spectra[index], self._name[index], self._kind[index],
+                          int(self._num_frames[index]), float(self._timestamp[index]))
+        return self.take(index)
+
+    @property
+    def spectra(self):
+        '''The spectra of shape (N, W), a view into the collection.
+
+        '''
+        return self._spectra[:self.count]
+
+    @property
+    def names(self):
+        return self._name[:self.count]
+
+    @property
+    def kinds(self):
+        return self._kind[:self.count]
+
+    @property
+    def num_frames(self):
+        return self._num_frames[:self.count]
+
+    @property
+    def timestamps(self):
+        return self._timestamp[:self.count]
+
+    def append(self, spectrum1d, name=None, kind=None, num_frames=-1, timestamp=None):
+        '''Appends a spectrum.
+
+        :params spectrum1d: The spectrum of length width
+        :type spectrum1d: numpy.ndarray
+        :params name: The spectrum name
+        :type name: str
+        :params kind: The spectrum kind (spectrum, background, ...)
+        :type kind: str
+        :params num_frames: The number of stacked frames (-1 if unknown)
+        :type num_frames: int
+        :params timestamp: Seconds since the epoch (nan if None)
+        :type timestamp: float
+        :returns: index (int): the row of the spectrum
+        :raises: AssertionError
+
+        '''
+        spectrum1d = np.asarray(spectrum1d)
+        assert spectrum1d.shape == (self.width,), 'spectrum1d must be of shape ({},).'.format(self.width)
+
+        if self.count == len(self._spectra):
+            self.reserve(2 * self.count)
+        i = self.count
+        self._spectra[i] = spectrum1d
+        self._name[i] = name
+        self._kind[i] = kind
+        self._num_frames[i] = num_frames
+        self._timestamp[i] = np.nan if timestamp is None else timestamp
+        self.count += 1
+        return i
+
+    def append_spectrum(self, spec):
+        '''Appends a processed spectrum.Spectrum.
+
+        The frame data is not kept. The timestamp is taken from
+        spec.timestamp, which the detector sets (nan if None).
+
+        '''
+        assert hasattr(spec, 'spectrum1d'), 'Spectrum must be processed before adding.'
+        return self.append(spec.spectrum1d, spec.name, spec.kind, spec.num_frames,
+                           getattr(spec, 'timestamp', None))
+
+    def extend(self, spectra, names=None, kinds=None, num_frames=-1, timestamps=None):
+        '''Appends a stack of spectra at once.
+
+        The metadata arguments are broadcast to the number of spectra.
+
+        :params spectra: The spectra of shape (N, width)
+        :type spectra: numpy.ndarray
+        :returns: None
+        :raises: AssertionError
+
+        '''
+        spectra = np.asarray(spectra)
+        assert spectra.ndim == 2 and spectra.shape[1] == self.width, \
+            'spectra must be of shape (N, {}).'.format(self.width)
+
+        n = len(spectra)
+        self.reserve(self.count + n)
+        rows = slice(self.count, self.count + n)
+        self._spectra[rows] = spectra
+        self._name[rows] = names
+        self._kind[rows] = kinds
+        self._num_frames[rows] = num_frames
+        self._timestamp[rows] = np.nan if timestamps is None else timestamps
+        self.count += n
+
+    def reserve(self, capacity):
+        '''Grows the preallocated arrays to hold at least capacity spectra.
+
+        '''
+        if capacity <= len(self._spectra):
+            return
+        for column in ('_spectra',) + tuple('_' + column for column in COLUMNS):
+            old = getattr(self, column)
+            new = np.empty((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self.count] = old[:self.count]
+            setattr(self, column, new)
+
+    def mask(self, kind=None, name=None, start=None, end=None, min_frames=None):
+        '''Returns the boolean mask of the rows matching all given conditions.
+
+        :params kind: The spectrum kind
+        :type kind: str
+        :params name: The spectrum name
+        :type name: str
+        :params start: Earliest timestamp (inclusive)
+        :type start: float
+        :params end: Latest timestamp (exclusive)
+        :type end: float
+        :params min_frames: Minimum number of stacked frames
+        :type min_frames: int
+        :returns: mask (ndarray of bool)
+
+        '''
+        mask = np.ones(self.count, dtype=bool)
+        if kind is not None:
+            mask &= self.kinds == kind
+        if name is not None:
+            mask &= self.names == name
+        if start is not None:
+            mask &= self.timestamps >= start
+        if end is not None:
+            mask &= self.timestamps < end
+        if min_frames is not None:
+            mask &= self.num_frames >= min_frames
+        return mask
+
+    def filter(self, **kwargs):
+        '''Returns a new collection of the rows matching all conditions, see mask.
+
+        '''
+        return self.take(self.mask(**kwargs))
+
+    def take(self, index):
+        '''Returns a new collection of the selected rows.
+
+        :params index: A slice, an index array or a boolean mask
+        :type index: slice or numpy.ndarray
+        :returns: collection (SpectrumCollection)
+
+        '''
+        spectra = self.spectra[index]
+        taken = SpectrumCollection(self.width, self.dtype, capacity=len(spectra))
+        taken.extend(spectra, self.names[index], self.kinds[index],
+                     self.num_frames[index], self.timestamps[index])
+        return taken
+
+    def mean(self, per_frame=False):
+        '''Returns the mean spectrum.
+
+        :params per_frame: If true every spectrum is divided by its num_frames first
+        :type per_frame: bool
+        :returns: mean (ndarray of float64)
+
+        '''
+        assert self.count, 'Collection is empty.'
+        if per_frame:
+            return self.per_frame().mean(axis=0)
+        return self.spectra.mean(axis=0, dtype=np.float64)
+
+    def std(self):
+        '''Returns the standard deviation of every column.
+
+        '''
+        assert self.count, 'Collection is empty.'
+        return self.spectra.std(axis=0, dtype=np.float64)
+
+    def sum(self):
+        '''Returns the sum of all spectra.
+
+        '''
+        return self.spectra.sum(axis=0, dtype=np.float64)
+
+    def per_frame(self):
+        '''Returns the spectra divided by their num_frames (unknown counts as 1).
+
+        '''
+        num_frames = np.where(self.num_frames > 0, self.num_frames, 1)
+        return self.spectra / num_frames[:, np.newaxis]
+
+    def group_mean(self, column='kind'):
+        '''Returns the mean spectrum of every distinct value of a metadata column.
+
+        :params column: name, kind or num_frames
+        :type column: str
+        :returns: means (dict): {value: mean spectrum}
+
+        '''
+        columns = {'name': self.names, 'kind': self.kinds, 'num_frames': self.num_frames}
+        assert column in columns, 'Unknown column: {}'.format(column)
+
+        values = columns[column]
+        means = {}
+        for value in dict.fromkeys(values):
+            means[value] = self.spectra[values == value].mean(axis=0, dtype=np.float64)
+        return means
+
+    def save(self, filename):
+        '''Saves the collection to a .npz file.
+
+        Names and kinds are stored as strings plus a mask of the missing
+        (None) values.
+
+        '''
+        columns = {}
+        for column, values in (('name', self.names), ('kind', self.kinds)):
+            missing = np.array([value is None for value in values], dtype=bool)
+            columns[column] = np.where(missing, '', values).astype(str)
+            columns[column + '_missing'] = missing
+        np.savez(filename, spectra=self.spectra, num_frames=self.num_frames, timestamp=self.timestamps, **columns)
+
+    @classmethod
+    def load(cls, filename):
+        '''Loads a collection saved with save.
+
+        :params filename: The .npz file
+        :type filename: str
+        :returns: collection (SpectrumCollection)
+
+        '''
+        with np.load(filename) as npz:
+            spectra = npz['spectra']
+            columns = {}
+            for column in ('name', 'kind'):
+                values = npz[column].astype(object)
+                if column + '_missing' in npz.files:
+                    values[npz[column + '_missing']] = None
+                columns[column] = values
+            collection = cls(spectra.shape[1], spectra.dtype, capacity=len(spectra))
+            collection.extend(spectra, columns['name'], columns['kind'], npz['num_frames'], npz['timestamp'])
+        return collection
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+'''
+Dark frame library for subtracting dark current without a fresh background.
+
+The dark signal of a webcam is an offset (bias) plus a dark current which
+grows linearly with the exposure time and strongly with the sensor
+temperature. Dark frames are recorded once for a few exposures at every
+gain and stored per frame (the mean of the recorded frames):
+
+    darks = DarkLibrary()
+    darks.record(detector, exposures=(50, 100, 200, 400), gain=0,
+                 num_frames=32, num_dropped_frames=10)
+    darks.save('darks.npz')
+
+A measurement then gets the dark frame for its conditions:
+
+    spectrum.subtract_dark(darks)  # exposure and gain of the measurement
+
+DarkLibrary.dark selects the dark frames of the same gain (the nearest gain
+if there is none) recorded closest to the measurement's temperature if
+known, otherwise closest in time, and interpolates them linearly in
+exposure (extrapolates outside the recorded range). Interpolated frames
+are cached with least recently used eviction.
+
+'''
+import collections
+import time
+
+import numpy as np
+
+
+DarkFrame = collections.namedtuple('DarkFrame', ['data', 'exposure', 'gain', 'timestamp', 'temperature', 'num_frames'])
+
+
+class DarkLibrary(object):
+    '''Dark frames indexed by exposure, gain, time and temperature.
+
+    :params cache_size: Number of interpolated dark frames kept in memory
+    :type cache_size: int
+    :params frames: The recorded dark frames
+    :type frames: list of DarkFrame
+
+    '''
+
+    def __init__(self, cache_size=16):
+        self.cache_size = cache_size
+        self.frames = []
+        self._cache = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.frames)
+
+    def add(self, data, exposure, gain, timestamp=None, temperature=None, num_frames=1):
+        '''Adds a dark frame.
+
+        :params data: The summed dark frames (divided by num_frames when stored)
+        :type data: numpy.ndarray
+        :params exposure: The exposure (camera units, as passed to Detector.pin)
+        :type exposure: float
+        :params gain: The gain
+        :type gain: float
+        :params timestamp: Seconds since the epoch (default: now)
+        :type timestamp: float
+        :params temperature: The sensor temperature (None if unknown)
+        :type temperature: float
+        :params num_frames: The number of summed frames
+        :type num_frames: int
+        :returns: None
+        :raises: AssertionError
+
+        '''
+        assert num_frames > 0, 'num_frames must be positive.'
+        if self.frames:
+            assert data.shape == self.frames[0].data.shape, 'All dark frames must have the same shape.'
+
+        data = np.asarray(data, dtype=np.float32) / np.float32(num_frames)
+        timestamp = time.time() if timestamp is None else timestamp
+        self.frames.append(DarkFrame(data, float(exposure), float(gain), float(timestamp),
+                                     None if temperature is None else float(temperature), num_frames))
+
+    def add_spectrum(self, spec, exposure=None, gain=None, temperature=None):
+        '''Adds a background spectrum.Spectrum measured with the light source off.
+
+        Exposure, gain and timestamp default to the values the detector
+        recorded in the spectrum.
+
+        '''
+        exposure = getattr(spec, 'exposure', None) if exposure is None else exposure
+        gain = getattr(spec, 'gain', None) if gain is None else gain
+        assert exposure is not None and gain is not None, 'Exposure and gain of the spectrum are unknown.'
+        assert spec.num_frames > 0, 'num_frames not set.'
+        self.add(spec.data, exposure, gain, getattr(spec, 'timestamp', None), temperature, spec.num_frames)
+
+    def record(self, detector, exposures, gain, num_frames, num_dropped_frames, temperature=None):
+        '''Measures and adds dark frames for several exposures.
+
+        The light source must be off. The detector stays pinned to the
+        last exposure.
+
+        :params detector: The detector
+        :type detector: detector.Detector
+        :params exposures: The exposures to record
+        :type exposures: sequence
+        :params gain: The gain
+        :type gain: float
+        :params num_frames: Number of frames per exposure
+        :type num_frames: int
+        :params num_dropped_frames: Maximum number of frames dropped after changing the exposure
+        :type num_dropped_frames: int
+        :returns: None
+
+        '''
+        for exposure in exposures:
+            detector.pin(exposure=exposure, gain=gain)
+            background = detector.measure_background(num_frames, num_dropped_frames,
+                                                     name='dark_{}_{}'.format(exposure, gain))
+            self.add(background.data, exposure, gain, time.time(), temperature, background.num_frames)
+
+    def dark(self, exposure, gain, timestamp=None, temperature=None):
+        '''Returns the per frame dark frame for the given conditions.
+
+        :params exposure: The exposure of the measurement
+        :type exposure: float
+        :params gain: The gain of the measurement
+        :type gain: float
+        :params timestamp: The time of the measurement (default: now)
+        :type timestamp: float
+        :params temperature: The sensor temperature (None: select by time)
+        :type temperature: float
+        :returns: dark (ndarray of float32): read only, shared with the cache
+        :raises: AssertionError
+
+        '''
+        assert self.frames, 'Dark library is empty.'
+
+        indices = self._select(gain, time.time() if timestamp is None else timestamp, temperature)
+        key = (float(exposure),) + tuple(indices)
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+
+        dark = self._interpolate(float(exposure), indices)
+        dark.flags.writeable = False
+        self._cache[key] = dark
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return dark
+
+    def save(self, filename):
+        '''Saves the dark frames to a .npz file.
+
+        '''
+        assert self.frames, 'Dark library is empty.'
+        temperatures = [np.nan if frame.temperature is None else frame.temperature for frame in self.frames]
+        np.savez(filename,
+                 data=np.stack([frame.data for frame in self.frames]),
+                 exposure=[frame.exposure for frame in self.frames],
+                 gain=[frame.gain for frame in self.frames],
+                 timestamp=[frame.timestamp for frame in self.frames],
+                 temperature=temperatures,
+                 num_frames=[frame.num_frames for frame in self.frames])
+
+    @classmethod
+    def load(cls, filename, cache_size=16):
+        '''Loads a library saved with save.
+
+        :params filename: The .npz file
+        :type filename: str
+        :returns: library (DarkLibrary)
+
+        '''
+        library = cls(cache_size)
+        with np.load(filename) as npz:
+            for i, data in enumerate(npz['data']):
+                temperature = None if np.isnan(npz['temperature'][i]) else float(npz['temperature'][i])
+                # The data is stored per frame already
+                library.frames.append(DarkFrame(data, float(npz['exposure'][i]), float(npz['gain'][i]),
+                                                float(npz['timestamp'][i]), temperature, int(npz['num_frames'][i])))
+        return library
+
+    def _select(self, gain, timestamp, temperature):
+        '''Returns the indices of the frames to interpolate from, one per exposure.
+
+        '''
+        gains = np.array([frame.gain for frame in self.frames])
+        nearest_gain = gains[np.argmin(np.abs(gains - gain))]
+
+        # {exposure: (distance, index)} of the best frame per exposure
+        best = {}
+        for i, frame in enumerate(self.frames):
+            if frame.gain != nearest_gain:
+                continue
+            if temperature is not None and frame.temperature is not None:
+                distance = (0, abs(frame.temperature - temperature))
+            else:
+                distance = (1, abs(frame.timestamp - timestamp))
+            if frame.exposure not in best or distance < best[frame.exposure][0]:
+                best[frame.exposure] = (distance, i)
+        return [best[exposure][1] for exposure in sorted(best)]
+
+    def _interpolate(self, exposure, indices):
+        '''Linear interpolation in exposure of the selected frames (sorted by exposure).
+
+        '''
+        exposures = [self.frames[i].exposure for i in indices]
+        if len(indices) == 1:
+            return self.frames[indices[0]].data.copy()
+
+        # The bracketing pair, or the two outermost frames for extrapolation
+        right = int(np.clip(np.searchsorted(exposures, exposure), 1, len(indices) - 1))
+        left = right - 1
+        weight = np.float32((exposure - exposures[left]) / (exposures[right] - exposures[left]))
+        low, high = self.frames[indices[left]].data, self.frames[indices[right]].data
+        return low + weight * (high - low)
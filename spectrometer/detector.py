@@ -3,45 +3,115 @@ import cv2
 import numpy as np
 import os.path
 import sys
+import time
 
+from hyperspectral import bin_rows
+from session import get_session
 from spectrum import Spectrum
-from source import Source
+from stacking import FLOAT32_EXACT, make_stack, RunningStats
+
+
+# {capture mode: (fourcc, bit depth)}
+# bgr is the default 8 bit color mode of opencv, all other modes request a
+# single channel pixel format from V4L2 and disable the conversion to BGR.
+CAPTURE_MODES = {
+    'bgr': (None, 8),
+    'mono': ('GREY', 8),
+    'y10': ('Y10 ', 10),
+    'y16': ('Y16 ', 16),
+}
 
 
 class Detector(object):
     '''Actually, this class is a webcam.
 
+    Single channel modes (mono, y10, y16) skip the color conversion in
+    Spectrum.process and move a third of the data per frame.
+    Not every camera supports them; if the camera still delivers
+    BGR frames they are converted to grayscale while capturing.
+
+    The capture is shared with all detectors on the same device and stays
+    open between measurements (see session.py).
+
     :params device: the X in /dev/videoX
     :type device: int
+    :params mode: capture mode, one of bgr (default), mono, y10, y16
+    :type mode: str
+    :params session: capture session to use instead of the pooled one of device
+    :type session: session.CaptureSession
     :params cap: opencv video capture
     :type cap: cv2.VideoCapture
     :params width: video capture frame width
     :type width: int
     :params height: video capture frame height
     :type height: int
+    :params bit_depth: bit depth of the captured pixels
+    :type bit_depth: int
 
     '''
 
-    def __init__(self, device=None):
-        if device:
+    def __init__(self, device=None, mode='bgr', session=None):
+        assert mode in CAPTURE_MODES, 'Unknown capture mode: {}'.format(mode)
+
+        if session is not None:
+            self.device = session.device
+        elif device:
             self.device = device
         else:
             self.device = self._find_video_device()
-        self.cap = cv2.VideoCapture(self.device)
-        self.width = self.cap.get(3)
-        self.height = self.cap.get(4)
+        self.session = session if session is not None else get_session(self.device)
+        self.session.ensure_open()
+        self.cap = self.session.cap
+        self.mode = mode
+        self._set_mode()
+        self.width = int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        self.height = int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+
+    def _set_mode(self):
+        '''Requests the pixel format of the capture mode from the camera.
+
+        Called before every measurement, another detector sharing the
+        session may have changed the format.
+
+        '''
+        fourcc, self.bit_depth = CAPTURE_MODES[self.mode]
+        if not self.session.set_format(fourcc):
+            string = 'WARNING: Camera does not support {} capture.'.format(self.mode)
+            print('\033[93m' + string + '\033[0m')
+
+    def pin(self, exposure=None, gain=None, white_balance=None):
+        '''Pins exposure, gain and white balance, see session.CaptureSession.pin.
+
+        After the first measurement with pinned values no frames are dropped
+        anymore.
+
+        '''
+        self.session.pin(exposure, gain, white_balance)
+
+    def release(self):
+        '''Releases the camera.
+
+        This closes the capture for all detectors sharing the session,
+        it is reopened by the next measurement of any of them.
+
+        '''
+        self.session.release()
 
     def measure_background(self, num_frames, num_dropped_frames, **kwargs):
         '''Measures and returns the background and writes an image file to disk.
 
         :params num_frames: number of captured frames
         :type num_frames: int
-        :params num_dropped_frames: number of dropped frames before collecting background spectrum
+        :params num_dropped_frames: maximum number of dropped frames before collecting background spectrum
         :type num_dropped_frames: int
         :params show: If true show last grabbed frame
         :type show: bool
         :params name: The spectrum name
         :type name: str
+        :params stack: Frame stacking, one of sum (default), sigma, median, minmax (see stacking.py)
+        :type stack: str
+        :params roi: Only stack the region (top, bottom, left, right) of the frames
+        :type roi: tuple
         :returns: background_avg (ndarry): the averaged background spectrum
 
         '''
@@ -50,9 +120,13 @@ class Detector(object):
         assert isinstance(show, bool), 'show must be of type bool.'
         assert isinstance(name, str), 'name must be of type str.'
 
-        background = Spectrum(kind='background', name=name)
-        background.add_data(self._measure(num_frames, num_dropped_frames, kind='background', show=show))
-        background.num_frames = num_frames
+        stack = self._measure(num_frames, num_dropped_frames, kind='background', show=show,
+                              stack=kwargs.get('stack', 'sum'), roi=kwargs.get('roi'))
+        background = Spectrum(kind='background', name=name, bit_depth=self.bit_depth)
+        background.add_data(stack.result())
+        background.num_frames = stack.count
+        background.saturation = stack.saturation
+        self._record_conditions(background)
         return background
 
     def measure_spectrum(self, num_frames, num_dropped_frames, **kwargs):
@@ -60,12 +134,16 @@ class Detector(object):
 
         :params num_frames: number of captured frames
         :type num_frames: int
-        :params num_dropped_frames: number of frames to drop before collecting spectrum frames
+        :params num_dropped_frames: maximum number of frames to drop before collecting spectrum frames
         :type num_dropped_frames: int
         :params show: If true show last grabbed frame
         :type show: bool
         :params name: The spectrum name
         :type name: str
+        :params stack: Frame stacking, one of sum (default), sigma, median, minmax (see stacking.py)
+        :type stack: str
+        :params roi: Only stack the region (top, bottom, left, right) of the frames
+        :type roi: tuple
         :returns: spectrum_avg (ndarry): the averaged spectrum
         :raises: AssertionError
 
@@ -75,15 +153,182 @@ class Detector(object):
         assert isinstance(show, bool), 'show must be of type bool.'
         assert isinstance(name, str), 'name must be of type str.'
 
-        spectrum = Spectrum(kind='spectrum', name=name)
-        spectrum.add_data(self._measure(num_frames, num_dropped_frames, kind='spectrum', show=show))
-        spectrum.num_frames = num_frames
+        stack = self._measure(num_frames, num_dropped_frames, kind='spectrum', show=show,
+                              stack=kwargs.get('stack', 'sum'), roi=kwargs.get('roi'))
+        spectrum = Spectrum(kind='spectrum', name=name, bit_depth=self.bit_depth)
+        spectrum.add_data(stack.result())
+        spectrum.num_frames = stack.count
+        spectrum.saturation = stack.saturation
+        self._record_conditions(spectrum)
+        return spectrum
+
+    def measure_adaptive(self, target_snr, max_time, num_dropped_frames, **kwargs):
+        '''Measures until the spectrum reaches a signal to noise ratio.
+
+        Every frame is reduced to a 1d spectrum (column sums of the grayscale
+        roi) and the running variance of these spectra gives the noise of
+        the integrated spectrum (see stacking.RunningStats.snr).
+        The measurement stops when target_snr is reached, after max_time
+        seconds or after max_frames frames, whichever comes first.
+
+        Frames with pixels at the maximum value of the bit depth are counted.
+        Saturated spectra are reported with a warning and the spectrum's
+        saturated attribute, their snr is meaningless.
+
+        :params target_snr: The signal to noise ratio to reach
+        :type target_snr: float
+        :params max_time: Maximum integration time in seconds
+        :type max_time: float
+        :params num_dropped_frames: maximum number of frames to drop before collecting spectrum frames
+        :type num_dropped_frames: int
+        :params min_frames: Minimum number of frames (default 3)
+        :type min_frames: int
+        :params max_frames: Maximum number of frames (default unlimited)
+        :type max_frames: int
+        :params kind: The spectrum kind (default spectrum)
+        :type kind: str
+        :params name: The spectrum name
+        :type name: str
+        :params stack: Frame stacking, one of sum (default), sigma, median, minmax (see stacking.py)
+        :type stack: str
+        :params roi: Only stack the region (top, bottom, left, right) of the frames
+        :type roi: tuple
+        :returns: spectrum (spectrum.Spectrum): with snr and saturated attributes
+        :raises: AssertionError
+
+        '''
+        name = kwargs.get('name', None)
+        kind = kwargs.get('kind', 'spectrum')
+        min_frames = kwargs.get('min_frames', 3)
+        max_frames = kwargs.get('max_frames', None)
+        roi = kwargs.get('roi')
+        assert isinstance(name, str), 'name must be of type str.'
+        assert isinstance(min_frames, int) and min_frames >= 2, 'min_frames must be an int >= 2.'
+
+        full_scale = 2 ** self.bit_depth - 1
+        stack = make_stack(kwargs.get('stack', 'sum'), full_scale=full_scale)
+        stats = RunningStats()
+        saturated_frames = 0
+        snr = 0.0
+
+        print('\033[1m' + 'Measuring {} to snr {}'.format(kind, target_snr) + '\033[0m')
+        self._set_mode()
+        dropped = self.session.settle(num_dropped_frames)
+        print('Dropped first {} frames'.format(dropped))
+
+        start = time.time()
+        while time.time() - start < max_time:
+            if max_frames is not None and stack.count >= max_frames:
+                break
+
+            ret, frame = self.cap.read()
+            if not ret or frame is None:
+                continue
+            if roi is not None:
+                frame = frame[roi[0]:roi[1], roi[2]:roi[3]]
+            frame = self._to_mode(frame)
+            if not stack.add(frame):
+                continue
+
+            # Before the grayscale conversion, which averages a saturated channel away
+            if frame.max() >= full_scale:
+                saturated_frames += 1
+            gray = frame if frame.ndim == 2 else cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+            stats.add(np.sum(gray, axis=0, dtype=np.float64))
+
+            if stats.count >= min_frames:
+                snr = stats.snr()
+                print('Frame {} snr {:.1f}\r'.format(stats.count, snr), end='')
+                if snr >= target_snr:
+                    break
+        print()
+
+        # Also warns if snr is nan
+        if not snr >= target_snr:
+            string = 'WARNING: snr {:.1f} below target after {} frames.'.format(snr, stack.count)
+            print('\033[93m' + string + '\033[0m')
+        if saturated_frames:
+            string = 'WARNING: {} of {} frames are saturated.'.format(saturated_frames, stack.count)
+            print('\033[93m' + string + '\033[0m')
+
+        assert stack.count > 0, 'No frames captured.'
+        spectrum = Spectrum(kind=kind, name=name, bit_depth=self.bit_depth)
+        spectrum.add_data(stack.result())
+        spectrum.num_frames = stack.count
+        spectrum.snr = snr
+        spectrum.saturated = saturated_frames > 0
+        spectrum.saturation = stack.saturation
+        self._record_conditions(spectrum)
+        return spectrum
+
+    def measure_line_scan(self, num_frames, num_dropped_frames, row_bin, **kwargs):
+        '''Measures a spatially resolved spectrum.
+
+        Every frame is binned in groups of row_bin rows while capturing
+        (see hyperspectral.bin_rows), so only the binned sum is kept.
+        The spectrum data has shape (rows // row_bin, columns).
+
+        :params num_frames: number of captured frames
+        :type num_frames: int
+        :params num_dropped_frames: maximum number of frames to drop before collecting spectrum frames
+        :type num_dropped_frames: int
+        :params row_bin: number of rows summed into one spatial row
+        :type row_bin: int
+        :params kind: The spectrum kind (default spectrum)
+        :type kind: str
+        :params name: The spectrum name
+        :type name: str
+        :params roi: Only use the region (top, bottom, left, right) of the frames
+        :type roi: tuple
+        :returns: spectrum (spectrum.Spectrum)
+        :raises: AssertionError
+
+        '''
+        name = kwargs.get('name', None)
+        kind = kwargs.get('kind', 'spectrum')
+        roi = kwargs.get('roi')
+        assert isinstance(num_frames, int), 'num_frames must be of type int.'
+        assert isinstance(name, str), 'name must be of type str.'
+
+        # The number of frames is known, float32 is used if it holds the binned sums exactly
+        full_scale = 2 ** self.bit_depth - 1
+        exact = num_frames * row_bin * full_scale <= FLOAT32_EXACT
+        dtype = np.float32 if exact else np.float64
+        data = None
+        count = 0
+
+        print('\033[1m' + 'Measuring line scan {}'.format(name) + '\033[0m')
+        self._set_mode()
+        dropped = self.session.settle(num_dropped_frames)
+        print('Dropped first {} frames'.format(dropped))
+
+        for i in range(num_frames):
+            ret, frame = self.cap.read()
+            if not ret or frame is None:
+                continue
+            if roi is not None:
+                frame = frame[roi[0]:roi[1], roi[2]:roi[3]]
+            frame = self._to_mode(frame)
+            if data is None:
+                data = np.zeros((frame.shape[0] // row_bin, frame.shape[1]), dtype=dtype)
+            bin_rows(frame, row_bin, out=data)
+            count += 1
+
+        assert count > 0, 'No frames captured.'
+        spectrum = Spectrum(kind=kind, name=name, bit_depth=self.bit_depth)
+        spectrum.add_data(data)
+        spectrum.num_frames = count
+        spectrum.row_bin = row_bin
+        self._record_conditions(spectrum)
         return spectrum
 
     def stream(self):
         '''Provides a stream from the detector.
 
+        The capture stays open after the window is closed with q.
+
         '''
+        self._set_mode()
         cv2.namedWindow('stream')
 
         while True:
@@ -92,22 +337,28 @@ class Detector(object):
 
             k = cv2.waitKey(1) & 0xFF
             if k == ord('q'):
-                self.cap.release()
                 cv2.destroyWindow('stream')
                 break
 
-    def _measure(self, num_frames, num_dropped_frames, kind, show):
+    def _measure(self, num_frames, num_dropped_frames, kind, show, stack='sum', roi=None):
         '''Records a spectrum.
 
         Used to carry out the background and spectrum measurments.
+        Up to num_dropped_frames frames are dropped until the exposure
+        has settled (none if the session is pinned and settled).
+        Failed reads are skipped, so the stack count can be lower than num_frames.
 
         :params num_frames: number of captured frames
         :type num_frames: int
-        :params num_dropped_frames: number of frames to drop before collecting spectrum frames
+        :params num_dropped_frames: maximum number of frames to drop before collecting spectrum frames
         :type num_dropped_frames: int
         :params show: If true show last grabbed frame
         :type show: bool
-        :returns: data (ndarry): the collected data
+        :params stack: The stacking method, see stacking.make_stack
+        :type stack: str
+        :params roi: The region (top, bottom, left, right) to stack
+        :type roi: tuple
+        :returns: stack: the stacked frames
         :raises: AssertionError
 
         '''
@@ -120,34 +371,75 @@ class Detector(object):
             cv2.namedWindow(kind)
             cv2.namedWindow('frame')
 
-#        data = np.ndarray(shape=(self.height, self.width, 3), dtype=np.int64)
-#        data = np.ndarray(shape=(self.height, self.width), dtype=np.uint16)
-        data = np.ndarray(shape=(self.height, self.width, 3), dtype=np.float32)
+        # float32 sums are promoted to float64 before they become inexact
+        stack = make_stack(stack, full_scale=2 ** self.bit_depth - 1)
+        if roi is not None:
+            top, bottom, left, right = roi
 
-        if not self.cap.isOpened():
-            self.cap.open(0)
         print('\033[1m' + 'Measuring {}'.format(kind) + '\033[0m')
-        print('Dropping first {} frames'.format(num_dropped_frames))
+        self._set_mode()
+        dropped = self.session.settle(num_dropped_frames)
+        print('Dropped first {} frames'.format(dropped))
         if show is True:
             print('Press q to abort.')
-        for i in range(num_dropped_frames):
-            ret, dropped = self.cap.read()
 
         for i in range(num_frames):
             print('Capturing frame {}\r'.format(i), end='')
             ret, frame = self.cap.read()
-            data += frame
+            if not ret or frame is None:
+                continue
+            if roi is not None:
+                frame = frame[top:bottom, left:right]
+            stack.add(self._to_mode(frame))
 
             if show is True:
                 cv2.imshow('frame', frame)
-                cv2.imshow(kind, data)
+                cv2.imshow(kind, stack.result())
 
                 k = cv2.waitKey(1) & 0xFF
                 if k == ord('q'):
-                    self.cap.release()
                     cv2.destroyWindow(kind)
                     break
-        return data
+        return stack
+
+    def _record_conditions(self, spectrum):
+        '''Stores time, exposure and gain of the capture in the spectrum (see dark.DarkLibrary).
+
+        Pinned values are used as passed to pin, cameras may report them rounded.
+        The timestamp is the end of the capture.
+
+        '''
+        spectrum.timestamp = time.time()
+        pinned = self.session.pinned
+        spectrum.exposure = pinned.get(cv2.CAP_PROP_EXPOSURE, self.cap.get(cv2.CAP_PROP_EXPOSURE))
+        spectrum.gain = pinned.get(cv2.CAP_PROP_GAIN, self.cap.get(cv2.CAP_PROP_GAIN))
+
+    def _to_mode(self, frame):
+        '''Converts a captured frame to the layout of the capture mode.
+
+        Single channel frames are returned as 2d arrays. If the camera
+        ignored the requested single channel format the BGR frame is
+        converted to grayscale.
+        Without the RGB conversion the V4L backend returns the raw buffer
+        as a 1xN uint8 array, it is unpacked to (height, width). y10 and y16
+        pixels are stored little endian in 16 bits.
+
+        :params frame: the captured frame
+        :type frame: numpy.ndarray
+        :returns: frame (ndarray)
+
+        '''
+        if self.mode == 'bgr':
+            return frame
+        if frame.ndim == 2 and frame.shape[0] == 1 and self.height > 1:
+            if self.bit_depth > 8:
+                frame = frame.view('<u2')
+            return frame.reshape(self.height, self.width)
+        if frame.ndim == 3 and frame.shape[2] == 3:
+            return cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        if frame.ndim == 3:
+            return frame[:, :, 0]
+        return frame
 
     def _find_video_device(self):
         if os.path.exists('/dev/video0'):
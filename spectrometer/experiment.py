@@ -1,109 +1,247 @@
+# -*- coding: utf-8 -*-
+'''
+Runs unattended experiments described by a json config file.
+
+Example config:
+
+    {
+        "name": "overnight",
+        "path": ".",
+        "detector": 0,
+        "mode": "bgr",
+        "source": "blue",
+        "repeat": 100,
+        "defaults": {"num_frames": 10, "num_dropped_frames": 10, "threshold": 10,
+                     "formats": [".npy", ".csv"]},
+        "steps": [
+            {"kind": "background", "name": "background", "source": "off"},
+            {"kind": "spectrum", "name": "sample", "source": "on",
+             "subtract": "background", "stack": "sigma"}
+        ]
+    }
+
+Step keys (missing keys are taken from defaults):
+    - kind: background or spectrum
+    - name: The step name, used in filenames and by subtract
+    - source: on, off or missing (source state is not changed)
+    - num_frames, num_dropped_frames, stack, roi: See Detector.measure_spectrum
+    - subtract: Name of an earlier step whose latest result is subtracted,
+      scaled to the number of frames of the step
+    - threshold: Threshold for Spectrum.process
+    - formats: Output files, .npy/.png/.tiff (data), .pks (pickled spectrum),
+      .csv/.xy/.dat (processed 1d spectrum)
+
+The output directory path/name contains settings.json (the config),
+log.json (one entry per measurement) and the spectra/ directory.
+An existing directory is never overwritten, a timestamp is appended instead.
+
+Processing and saving of measurement N runs in a worker thread while
+measurement N+1 is acquired. At most MAX_PENDING measurements wait for
+the worker, acquisition blocks until the oldest is saved otherwise.
+log.json is rewritten whenever a measurement is saved. If the run fails,
+the saved measurements are still logged and the source is switched off
+(a failure to switch it off is only reported).
+
+Run with:
+
+    python experiment.py config.json
+
+'''
+import collections
+import concurrent.futures
+import json
+import os
+import os.path
+import time
+
 from detector import Detector
-from spectrum import Spectrum, write, load
-from processor import Processor
-
-d = Detector(0)
-p = Processor()
-
-b = d.measure_background(1, 10, kind='background', name='background')
-write(b)
-b.show()
-
-s = d.measure_spectrum(1, 10, kind='background2', name='background2')
-write(s)
-s.show()
-
-s.subtract(b)
-write(s)
-s.show()
-
-p.load('spectrum.npy')
-p.process(10)
-p.write('spectrum.csv')
-p.show()
-
-
-#import os
-#import time
-
-#from spectrometer import Spectrometer
-
-
-#def experiment_from_file(filename):
-#    pass
-
-#class Experiment(object):
-#    def __init__(self):
-#        self.settings = {}
-#        self.created = time.localtime()
-#        self.settings['created'] = time.asctime(self.created)
-#        self.spectra = []
-#        self.spectrometer = None
-
-#    def setup(self):
-#        self._make_dirs()
-#        self._set_file_prefix()
-#        self._set_num_frames()
-
-#        self.spectrometer = Spectrometer()
-
-#        for k, v in self.settings.items():
-#            self.write_setting(k, v)
-
-#    def _make_dirs(self):
-#        current_dir = os.getcwd()
-#        path_created = False
-
-#        while not path_created:
-#            name = input('Experiment name: ')
-#            path = os.path.join(current_dir, name)
-#            if os.path.exists(path):
-#                print('Experiment exists on path!\nPlease choose different name.')
-#            else:
-#                spectra_path = os.path.join(path, 'spectra')
-#                os.mkdir(path)
-#                os.mkdir(spectra_path)
-#                self.name = name
-#                self.path = path
-#                path_created = True
-
-#        self.settings['path'] = self.path
-#        self.settings['name'] = self.name
-
-#    def _set_file_prefix(self):
-#        prefix = input('Enter file prefix [{}]:'.format(self.name))
-#        if not prefix:
-#            self.prefix = self.name
-#        else:
-#            self.prefix = prefix
-
-#        self.settings['prefix'] = self.prefix
-
-#    def _set_num_frames(self):
-#        num_frames_set = False
-#        num_dropped_frames_set = False
-#        while not num_frames_set:
-#            num_frames = input('Enter number of frames to collect: ')
-#            if isinstance(int(num_frames), int):
-#                self.num_frames = num_frames
-#                num_frames_set = True
-#        while not num_dropped_frames_set:
-#            num_dropped_frames = input('Enter number of frames to drop: ')
-#            if isinstance(int(num_dropped_frames), int):
-#                self.num_dropped_frames = num_dropped_frames
-#                num_dropped_frames_set = True
-
-#        self.settings['num_frames'] = self.num_frames
-#        self.settings['num_dropped_frames'] = self.num_dropped_frames
-
-#    def write_setting(self, parameter, value):
-#        filename = os.path.join(self.path, 'settings.py')
-#        with open(filename, 'a') as outf:
-#            outf.write('{} : {}\n'.format(parameter, value))
-
-#    def run(self):
-#        pass
-
-#if __name__ == '__main__':
-#    ex = Experiment()
-#    ex.setup()
+from processor import write_spectrum1d
+from spectrum import Spectrum, write
+
+
+# Measurements waiting for processing, each keeps its frame data in memory
+MAX_PENDING = 2
+
+DEFAULT_STEP = {
+    'kind': 'spectrum',
+    'num_frames': 10,
+    'num_dropped_frames': 10,
+    'threshold': 10,
+    'formats': ['.npy', '.csv'],
+}
+
+
+def experiment_from_file(filename):
+    '''Creates an experiment from a json config file.
+
+    :params filename: The config file
+    :type filename: str
+    :returns: experiment (Experiment)
+
+    '''
+    with open(filename) as inf:
+        return Experiment(json.load(inf))
+
+
+class Experiment(object):
+    '''A sequence of measurements and processing steps.
+
+    :params settings: The experiment config, see module docstring
+    :type settings: dict
+
+    '''
+
+    def __init__(self, settings):
+        assert 'name' in settings, 'Experiment name missing.'
+        assert settings.get('steps'), 'Experiment has no steps.'
+
+        self.settings = dict(settings)
+        self.created = time.localtime()
+        self.settings['created'] = time.asctime(self.created)
+        self.name = settings['name']
+        self.steps = [self._step(step) for step in settings['steps']]
+        self.log = []
+        self.latest = {}  # {step name: latest spectrum}
+
+    def _step(self, step):
+        merged = dict(DEFAULT_STEP)
+        merged.update(self.settings.get('defaults', {}))
+        merged.update(step)
+        assert merged['kind'] in ('spectrum', 'background'), 'Unknown kind: {}'.format(merged['kind'])
+        assert 'name' in merged, 'Step name missing.'
+        return merged
+
+    def setup(self):
+        '''Creates the output directories and writes the settings.
+
+        '''
+        path = os.path.join(self.settings.get('path', '.'), self.name)
+        if os.path.exists(path):
+            path += time.strftime('_%Y%m%d_%H%M%S', self.created)
+        self.path = path
+        self.spectra_path = os.path.join(path, 'spectra')
+        os.makedirs(self.spectra_path)
+
+        self.settings['output'] = path
+        with open(os.path.join(path, 'settings.json'), 'w') as outf:
+            json.dump(self.settings, outf, indent=4)
+
+    def run(self, detector=None, source=None):
+        '''Runs all steps repeat times.
+
+        :params detector: The detector (default: from the config)
+        :type detector: detector.Detector
+        :params source: The light source (default: from the config, None if not configured)
+        :type source: source.Source
+        :returns: log (list of dicts): one entry per measurement
+
+        '''
+        if not hasattr(self, 'path'):
+            self.setup()
+        if detector is None:
+            detector = Detector(self.settings.get('detector'), mode=self.settings.get('mode', 'bgr'))
+        if source is None and self.settings.get('source'):
+            from source import Source
+            source = Source(self.settings['source'])
+
+        pending = collections.deque()
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+                for repeat in range(self.settings.get('repeat', 1)):
+                    for step in self.steps:
+                        spec = self._measure(detector, source, step, repeat)
+                        reference = self.latest.get(step.get('subtract'))
+                        self.latest[step['name']] = spec
+                        pending.append(executor.submit(self._finish, spec, step, repeat, reference))
+
+                        # Log finished steps in order, errors are raised here
+                        while pending and (pending[0].done() or len(pending) > MAX_PENDING):
+                            self._add_entry(pending.popleft().result())
+                while pending:
+                    self._add_entry(pending.popleft().result())
+        finally:
+            # The executor waited for the worker, log what it saved before an error
+            for future in pending:
+                if not future.cancelled() and future.exception() is None:
+                    self.log.append(future.result())
+            self._write_log()
+            if source is not None and self.settings.get('source'):
+                # An error here must not replace the error of the run
+                try:
+                    source.off()
+                except Exception as error:
+                    string = 'WARNING: Could not switch off the light source: {}'.format(error)
+                    print('\033[93m' + string + '\033[0m')
+        return self.log
+
+    def _measure(self, detector, source, step, repeat):
+        if source is not None and step.get('source') == 'on':
+            source.on()
+        elif source is not None and step.get('source') == 'off':
+            source.off()
+
+        kwargs = {key: step[key] for key in ('stack', 'roi') if key in step}
+        name = '{}_{:04d}'.format(step['name'], repeat)
+        if step['kind'] == 'background':
+            return detector.measure_background(step['num_frames'], step['num_dropped_frames'], name=name, **kwargs)
+        return detector.measure_spectrum(step['num_frames'], step['num_dropped_frames'], name=name, **kwargs)
+
+    def _finish(self, spec, step, repeat, reference):
+        '''Processes and saves a measurement (runs in the worker thread).
+
+        :returns: entry (dict): the log entry
+
+        '''
+        if reference is not None:
+            spec.subtract(_scaled(reference, spec.num_frames))
+        spec.process(step['threshold'])
+
+        files = []
+        base = os.path.join(self.spectra_path, spec.name)
+        for ext in step['formats']:
+            filename = base + ext
+            if ext == '.pks':
+                write(spec, filename)
+            elif ext in ('.csv', '.xy', '.dat'):
+                write_spectrum1d(spec.spectrum1d, filename)
+            else:
+                spec.save(filename)
+            files.append(os.path.relpath(filename, self.path))
+
+        return {
+            'name': spec.name,
+            'step': step['name'],
+            'kind': spec.kind,
+            'repeat': repeat,
+            'timestamp': spec.timestamp,
+            'num_frames': spec.num_frames,
+            'subtracted': reference.name if reference is not None else None,
+            'files': files,
+        }
+
+    def _add_entry(self, entry):
+        self.log.append(entry)
+        self._write_log()
+
+    def _write_log(self):
+        with open(os.path.join(self.path, 'log.json'), 'w') as outf:
+            json.dump(self.log, outf, indent=4)
+
+
+def _scaled(reference, num_frames):
+    '''Returns the reference scaled to num_frames frames (the reference itself if it has num_frames).
+
+    '''
+    if reference.num_frames == num_frames:
+        return reference
+    scaled = Spectrum(kind=reference.kind, name=reference.name)
+    scaled.add_data(reference.data * (num_frames / reference.num_frames))
+    scaled.num_frames = num_frames
+    return scaled
+
+
+if __name__ == '__main__':
+    import sys
+    assert len(sys.argv) == 2, 'Usage: python experiment.py config.json'
+
+    experiment_from_file(sys.argv[1]).run()
@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+'''
+Shared memory ring buffer between acquisition and processing processes.
+
+One process publishes frames (or reduced rois, spectra) into a FrameBus,
+any number of processes attach a FrameReader by the bus name and read the
+frames without copying or pickling them:
+
+    # acquisition process
+    bus = FrameBus('spectrometer', shape=(200, 920), dtype=np.float32)
+    bus.publish(roi)
+
+    # consumer process (live plot, archiver, peak tracker, ...)
+    reader = FrameReader('spectrometer')
+    seq, frame, timestamp = reader.read(timeout=1)
+
+Every published frame gets a sequence number. Frame seq is stored in
+slot seq % slots, each slot carries the sequence number of its content,
+which readers use to detect frames that were overwritten while reading.
+
+Policies of the publisher when the ring is full:
+    - overwrite: The oldest frame is overwritten, slow readers skip frames
+      (counted in FrameReader.dropped).
+    - block: publish waits until every reader released the oldest frame.
+      Readers whose process ended without closing them (e.g. crashed)
+      are dropped, this is only detected on posix systems.
+
+'''
+import os
+import time
+
+import numpy as np
+from multiprocessing import shared_memory
+
+
+MAGIC = 0x5350454342555331  # 'SPECBUS1'
+MAX_DIMS = 8
+MAX_READERS = 16
+
+# Layout of the int64 header
+_SLOTS = 1
+_NDIM = 2
+_SHAPE = 3
+_HEAD = _SHAPE + MAX_DIMS
+_CLOSED = _HEAD + 1
+_READERS = _CLOSED + 1
+_PIDS = _READERS + MAX_READERS
+HEADER_WORDS = _PIDS + MAX_READERS
+DTYPE_BYTES = 16
+
+# Reader cursor of an unused reader entry
+_FREE = -2
+
+
+class FrameBus(object):
+    '''Publishing end of a shared memory ring buffer.
+
+    :params name: The shared memory name, readers attach with it
+    :type name: str
+    :params shape: The frame shape
+    :type shape: tuple
+    :params dtype: The frame dtype
+    :type dtype: numpy.dtype
+    :params slots: Number of frames in the ring
+    :type slots: int
+    :params policy: overwrite (default) or block, see module docstring
+    :type policy: str
+
+    '''
+
+    def __init__(self, name, shape, dtype, slots=8, policy='overwrite'):
+        assert policy in ('overwrite', 'block'), 'policy must be overwrite or block.'
+        assert len(shape) <= MAX_DIMS, 'At most {} dimensions.'.format(MAX_DIMS)
+        assert slots > 0, 'slots must be positive.'
+
+        dtype = np.dtype(dtype)
+        size = _layout_size(shape, dtype, slots)
+        self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        self.name = name
+        self.policy = policy
+
+        header = np.ndarray(HEADER_WORDS, dtype=np.int64, buffer=self.shm.buf)
+        header[0] = MAGIC
+        header[_SLOTS] = slots
+        header[_NDIM] = len(shape)
+        header[_SHAPE:_SHAPE + len(shape)] = shape
+        header[_HEAD] = -1
+        header[_CLOSED] = 0
+        header[_READERS:_PIDS] = _FREE
+        header[_PIDS:] = 0
+        dtype_str = dtype.str.encode().ljust(DTYPE_BYTES, b'\0')
+        self.shm.buf[HEADER_WORDS * 8:HEADER_WORDS * 8 + DTYPE_BYTES] = dtype_str
+
+        self.header, self.sequences, self.timestamps, self.frames = _views(self.shm.buf, shape, dtype, slots)
+        self.sequences[:] = -1
+        self.slots = slots
+
+    def publish(self, frame, timestamp=None, timeout=None):
+        '''Copies a frame into the next slot.
+
+        :params frame: The frame, must match shape and dtype of the bus (it is cast otherwise)
+        :type frame: numpy.ndarray
+        :params timestamp: Seconds since the epoch (default: now)
+        :type timestamp: float
+        :params timeout: Seconds to wait for readers with policy block (None: forever)
+        :type timeout: float
+        :returns: seq (int): the sequence number, None if the timeout expired
+
+        '''
+        seq = int(self.header[_HEAD]) + 1
+        slot = seq % self.slots
+
+        if self.policy == 'block' and seq >= self.slots:
+            if not self._wait_for_readers(seq - self.slots, timeout):
+                return None
+
+        # Mark the slot as being written, readers retry or skip it
+        self.sequences[slot] = -1
+        np.copyto(self.frames[slot], frame, casting='unsafe')
+        self.timestamps[slot] = time.time() if timestamp is None else timestamp
+        self.sequences[slot] = seq
+        self.header[_HEAD] = seq
+        return seq
+
+    def close(self):
+        '''Marks the bus closed for readers and frees the shared memory.
+
+        '''
+        self.header[_CLOSED] = 1
+        del self.header, self.sequences, self.timestamps, self.frames
+        self.shm.close()
+        self.shm.unlink()
+
+    def _wait_for_readers(self, seq, timeout):
+        '''Waits until all readers released frame seq.
+
+        Readers of processes which do not exist anymore are dropped.
+
+        '''
+        start = time.time()
+        while True:
+            cursors = self.header[_READERS:_PIDS]
+            waiting = np.flatnonzero((cursors != _FREE) & (cursors < seq))
+            if waiting.size == 0:
+                return True
+            for index in waiting:
+                if not _alive(int(self.header[_PIDS + index])):
+                    cursors[index] = _FREE
+            if timeout is not None and time.time() - start > timeout:
+                return False
+            time.sleep(0.0005)
+
+
+class FrameReader(object):
+    '''Reading end of a FrameBus.
+
+    read() returns a view into shared memory. The frame stays valid until the
+    next read() with policy block. With policy overwrite the publisher may
+    overwrite it when the reader falls behind by more than slots frames;
+    check with valid(seq) after using the view, or read with copy=True.
+
+    :params name: The name of the bus
+    :type name: str
+    :params start: latest (default): start with the next published frame,
+        oldest: start with the oldest frame in the ring
+    :type start: str
+    :params dropped: Number of frames skipped because they were overwritten
+    :type dropped: int
+
+    '''
+
+    def __init__(self, name, start='latest'):
+        assert start in ('latest', 'oldest'), 'start must be latest or oldest.'
+
+        self.shm = _attach(name)
+        header = np.ndarray(HEADER_WORDS, dtype=np.int64, buffer=self.shm.buf)
+        assert header[0] == MAGIC, 'Not a frame bus: {}'.format(name)
+
+        slots = int(header[_SLOTS])
+        shape = tuple(int(n) for n in header[_SHAPE:_SHAPE + header[_NDIM]])
+        dtype_str = bytes(self.shm.buf[HEADER_WORDS * 8:HEADER_WORDS * 8 + DTYPE_BYTES])
+        dtype = np.dtype(dtype_str.rstrip(b'\0').decode())
+        self.header, self.sequences, self.timestamps, self.frames = _views(self.shm.buf, shape, dtype, slots)
+        self.slots = slots
+        self.shape = shape
+        self.dtype = dtype
+        self.dropped = 0
+
+        head = int(header[_HEAD])
+        self.next = head + 1 if start == 'latest' else max(head - slots + 1, 0)
+        self.index = self._register()
+
+    def read(self, timeout=None, copy=False):
+        '''Returns the next frame.
+
+        :params timeout: Seconds to wait for a new frame (None: forever)
+        :type timeout: float
+        :params copy: If true return a copy instead of a shared memory view
+        :type copy: bool
+        :returns: seq (int), frame (ndarray), timestamp (float);
+            None, None, None on timeout or when the bus was closed
+
+        '''
+        # Frames before next are released, a blocking publisher may reuse their slots
+        self.header[_READERS + self.index] = self.next - 1
+
+        start = time.time()
+        while True:
+            if self.header[_CLOSED]:
+                return None, None, None
+
+            head = int(self.header[_HEAD])
+            if head >= self.next:
+                if head - self.next >= self.slots:
+                    oldest = head - self.slots + 1
+                    self.dropped += oldest - self.next
+                    self.next = oldest
+
+                seq = self.next
+                slot = seq % self.slots
+                if self.sequences[slot] == seq:
+                    frame = self.frames[slot].copy() if copy else self.frames[slot]
+                    timestamp = float(self.timestamps[slot])
+                    if self.sequences[slot] == seq:
+                        self.next = seq + 1
+                        return seq, frame, timestamp
+                # Overwritten while reading, skip it
+                self.dropped += 1
+                self.next = seq + 1
+                continue
+
+            if timeout is not None and time.time() - start > timeout:
+                return None, None, None
+            time.sleep(0.0005)
+
+    def valid(self, seq):
+        '''Returns True if frame seq is still in its slot.
+
+        '''
+        return self.sequences[seq % self.slots] == seq
+
+    def close(self):
+        '''Unregisters the reader and detaches from the shared memory.
+
+        '''
+        if not self.header[_CLOSED]:
+            self.header[_READERS + self.index] = _FREE
+        del self.header, self.sequences, self.timestamps, self.frames
+        self.shm.close()
+
+    def _register(self):
+        '''Claims a free reader entry for the back pressure cursor.
+
+        Readers must not register concurrently.
+
+        '''
+        cursors = self.header[_READERS:_PIDS]
+        free = np.flatnonzero(cursors == _FREE)
+        assert free.size, 'Too many readers (max {}).'.format(MAX_READERS)
+        cursors[free[0]] = self.next - 1
+        self.header[_PIDS + free[0]] = os.getpid()
+        return int(free[0])
+
+
+def _alive(pid):
+    '''Returns False if the process pid has ended.
+
+    Only posix systems are checked, signal 0 tests for the process without
+    sending a signal. On Windows os.kill would terminate the process.
+
+    '''
+    if os.name != 'posix' or pid <= 0:
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # The process exists, but belongs to another user
+        pass
+    return True
+
+
+def _layout_size(shape, dtype, slots):
+    frame_bytes = int(np.prod(shape)) * dtype.itemsize
+    return _data_offset(slots) + slots * _aligned(frame_bytes)
+
+
+def _data_offset(slots):
+    # header, dtype string, slot sequences and timestamps
+    return _aligned(HEADER_WORDS * 8 + DTYPE_BYTES + slots * 16)
+
+
+def _aligned(size, alignment=64):
+    return (size + alignment - 1) // alignment * alignment
+
+
+def _views(buf, shape, dtype, slots):
+    '''Returns header, sequences, timestamps and frames views of the shared memory.
+
+    '''
+    header = np.ndarray(HEADER_WORDS, dtype=np.int64, buffer=buf)
+    offset = HEADER_WORDS * 8 + DTYPE_BYTES
+    sequences = np.ndarray(slots, dtype=np.int64, buffer=buf, offset=offset)
+    timestamps = np.ndarray(slots, dtype=np.float64, buffer=buf, offset=offset + slots * 8)
+
+    frame_bytes = _aligned(int(np.prod(shape)) * dtype.itemsize)
+    frames = [np.ndarray(shape, dtype=dtype, buffer=buf, offset=_data_offset(slots) + i * frame_bytes)
+              for i in range(slots)]
+    return header, sequences, timestamps, frames
+
+
+def _attach(name):
+    '''Attaches to existing shared memory without taking ownership.
+
+    Before Python 3.13 the resource tracker of an attaching process unlinks
+    the memory at exit, which would destroy the bus of the publisher.
+    Registering is skipped instead of unregistering afterwards, because
+    forked readers share the tracker with the publisher.
+
+    '''
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        from multiprocessing import resource_tracker
+        register = resource_tracker.register
+        resource_tracker.register = lambda name, rtype: None
+        try:
+            return shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
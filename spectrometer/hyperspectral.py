@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+'''
+Spatially resolved (line scan) spectra.
+
+The rows of a frame image different positions along the slit. Instead of
+summing all rows into one spectrum1d, groups of row_bin rows are summed,
+which gives a spatial x spectral array per frame (see bin_rows and
+Detector.measure_line_scan). Successive scans are written as planes of a
+hyperspectral cube of shape (scans, rows, columns) with CubeWriter.
+
+Cubes are .npy files, which can be opened while they are written:
+
+    cube = load_cube('scan.npy')  # memory mapped, shape (scans, rows, columns)
+
+'''
+import numpy as np
+
+
+# Fixed size of the .npy header, so it can be rewritten in place when the cube grows
+_NPY_HEADER_SIZE = 256
+
+
+def bin_rows(frame, row_bin, out=None):
+    '''Sums groups of row_bin rows of a frame.
+
+    Color frames are converted to grayscale first. Remaining rows which
+    do not fill a whole group are dropped.
+
+    :params frame: The frame of shape (rows, columns) or (rows, columns, 3)
+    :type frame: numpy.ndarray
+    :params row_bin: Number of rows per group
+    :type row_bin: int
+    :params out: Array of shape (rows // row_bin, columns) to add the binned frame to
+    :type out: numpy.ndarray
+    :returns: binned (ndarray): shape (rows // row_bin, columns)
+    :raises: AssertionError
+
+    '''
+    assert isinstance(row_bin, int) and row_bin > 0, 'row_bin must be a positive int.'
+
+    if frame.ndim == 3:
+        import cv2
+        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+
+    rows = frame.shape[0] // row_bin
+    groups = frame[:rows * row_bin].reshape(rows, row_bin, frame.shape[1])
+    if out is None:
+        return groups.sum(axis=1, dtype=np.float64)
+    out += groups.sum(axis=1, dtype=out.dtype)
+    return out
+
+
+class CubeWriter(object):
+    '''Appends planes to a hyperspectral cube stored as .npy file.
+
+    The header is rewritten with the current number of planes on every
+    flush, so readers (load_cube) always see complete planes.
+
+    :params filename: The .npy file
+    :type filename: str
+    :params plane_shape: The shape of one plane (rows, columns)
+    :type plane_shape: tuple
+    :params dtype: The dtype of the cube
+    :type dtype: numpy.dtype
+    :params count: The number of written planes
+    :type count: int
+
+    '''
+
+    def __init__(self, filename, plane_shape, dtype=np.float32):
+        self.filename = filename
+        self.plane_shape = tuple(plane_shape)
+        self.dtype = np.dtype(dtype)
+        self.count = 0
+        self.file = open(filename, 'wb')
+        self._write_header()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def append(self, plane):
+        '''Appends a plane and updates the header.
+
+        :params plane: The plane
+        :type plane: numpy.ndarray
+        :returns: None
+        :raises: AssertionError
+
+        '''
+        assert plane.shape == self.plane_shape, 'plane must be of shape {}.'.format(self.plane_shape)
+
+        self.file.seek(0, 2)
+        self.file.write(np.ascontiguousarray(plane, dtype=self.dtype).tobytes())
+        self.count += 1
+        self.flush()
+
+    def flush(self):
+        self._write_header()
+        self.file.flush()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+    def _write_header(self):
+        header = repr({
+            'descr': np.lib.format.dtype_to_descr(self.dtype),
+            'fortran_order': False,
+            'shape': (self.count,) + self.plane_shape,
+        })
+        magic = np.lib.format.magic(1, 0)
+        # magic string, 2 byte header length, header padded with spaces and terminated by newline
+        length = _NPY_HEADER_SIZE - len(magic) - 2
+        header = header.ljust(length - 1) + '\n'
+        self.file.seek(0)
+        self.file.write(magic + length.to_bytes(2, 'little') + header.encode('latin1'))
+
+
+def load_cube(filename):
+    '''Opens a cube memory mapped.
+
+    :params filename: The .npy file
+    :type filename: str
+    :returns: cube (ndarray): shape (scans, rows, columns)
+
+    '''
+    return np.load(filename, mmap_mode='r')
+
+
+def scan(detector, writer, num_scans, num_frames, num_dropped_frames, row_bin, **kwargs):
+    '''Measures num_scans line scans and appends them to a cube.
+
+    See Detector.measure_line_scan for the keyword arguments.
+
+    :params detector: The detector
+    :type detector: detector.Detector
+    :params writer: The cube writer, created from the first scan if None
+    :type writer: CubeWriter
+    :params num_scans: Number of scans
+    :type num_scans: int
+    :returns: writer (CubeWriter)
+
+    '''
+    name = kwargs.pop('name', 'scan')
+    for i in range(num_scans):
+        spectrum = detector.measure_line_scan(num_frames, num_dropped_frames, row_bin,
+                                              name='{}_{}'.format(name, i), **kwargs)
+        if writer is None:
+            writer = CubeWriter(name + '.npy', spectrum.data.shape, spectrum.data.dtype)
+        writer.append(spectrum.data)
+    return writer
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+'''
+Reference spectra library for identifying samples.
+
+The reference spectra are kept as rows of one matrix, preprocessed for
+each comparison method, so matching any number of query spectra is a
+single matrix product:
+
+    - cosine: Rows scaled to unit length, score = cosine similarity.
+    - correlation: Rows centered and scaled to unit length, score = Pearson r.
+    - unmix: Least squares abundances of all references (pseudo inverse).
+
+Example:
+    library = Library()
+    library.add('neon', neon.spectrum1d)
+    library.add('mercury', mercury.spectrum1d)
+    library.build(cache='library.npz')
+    names, scores = library.match(spectra, k=3)
+
+'''
+import hashlib
+import os.path
+
+import numpy as np
+
+
+class Library(object):
+    '''A library of reference spectra.
+
+    :params names: The reference names
+    :type names: list
+    :params spectra: The reference spectra (rows)
+    :type spectra: numpy.ndarray
+
+    '''
+
+    def __init__(self):
+        self.names = []
+        self._spectra = []
+        self.spectra = None
+        self._index = None
+
+    def __len__(self):
+        return len(self.names)
+
+    def add(self, name, spectrum1d):
+        '''Adds a reference spectrum.
+
+        :params name: The reference name
+        :type name: str
+        :params spectrum1d: The reference spectrum
+        :type spectrum1d: numpy.ndarray
+        :returns: None
+        :raises: AssertionError
+
+        '''
+        spectrum1d = np.asarray(spectrum1d, dtype=np.float32)
+        assert spectrum1d.ndim == 1, 'spectrum1d must be one dimensional.'
+        if self._spectra:
+            assert spectrum1d.shape == self._spectra[0].shape, 'All spectra must have the same length.'
+
+        self.names.append(name)
+        self._spectra.append(spectrum1d)
+        self._index = None
+
+    def add_spectrum(self, spec):
+        '''Adds a processed spectrum.Spectrum under its name.
+
+        '''
+        assert hasattr(spec, 'spectrum1d'), 'Spectrum must be processed before adding.'
+        self.add(spec.name, spec.spectrum1d)
+
+    def build(self, cache=None):
+        '''Builds the preprocessed matrices.
+
+        With cache set, the matrices are loaded from the cache file if it was
+        built from the same references, otherwise they are calculated and
+        written to it.
+
+        :params cache: The .npz cache file
+        :type cache: str
+        :returns: None
+        :raises: AssertionError
+
+        '''
+        assert self._spectra, 'Library is empty.'
+
+        self.spectra = np.stack(self._spectra)
+        checksum = self._checksum()
+        if cache and os.path.isfile(cache):
+            with np.load(cache) as npz:
+                if str(npz['checksum']) == checksum:
+                    self._index = {key: npz[key] for key in ('cosine', 'correlation', 'pinv')}
+                    return
+
+        self._index = {
+            'cosine': _unit_rows(self.spectra),
+            'correlation': _unit_rows(self.spectra - self.spectra.mean(axis=1, keepdims=True)),
+            # queries @ pinv gives the least squares abundances of all references
+            'pinv': np.linalg.pinv(self.spectra).astype(np.float32),
+        }
+        if cache:
+            np.savez(cache, checksum=checksum, **self._index)
+
+    def match(self, queries, method='cosine', k=1):
+        '''Finds the k best matching references for each query.
+
+        :params queries: A spectrum1d or a stack of spectra of shape (N, W)
+        :type queries: numpy.ndarray
+        :params method: cosine or correlation
+        :type method: str
+        :params k: Number of matches per query
+        :type k: int
+        :returns: names (list of lists), scores (ndarray of shape (N, k)),
+            best matches first
+        :raises: AssertionError
+
+        '''
+        assert method in ('cosine', 'correlation'), 'Unknown method: {}'.format(method)
+
+        scores = self.scores(queries, method)
+        k = min(k, scores.shape[1])
+        best = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        best_scores = np.take_along_axis(scores, best, axis=1)
+        order = np.argsort(-best_scores, axis=1)
+        best = np.take_along_axis(best, order, axis=1)
+        best_scores = np.take_along_axis(best_scores, order, axis=1)
+
+        names = [[self.names[i] for i in row] for row in best]
+        return names, best_scores
+
+    def scores(self, queries, method='cosine'):
+        '''Returns the similarity of every query to every reference.
+
+        :params queries: A spectrum1d or a stack of spectra of shape (N, W)
+        :type queries: numpy.ndarray
+        :params method: cosine or correlation
+        :type method: str
+        :returns: scores (ndarray): shape (N, number of references)
+
+        '''
+        queries = self._queries(queries)
+        if method == 'correlation':
+            queries = queries - queries.mean(axis=1, keepdims=True)
+        return _unit_rows(queries) @ self._index[method].T
+
+    def unmix(self, queries):
+        '''Least squares decomposition of queries into the references.
+
+        :params queries: A spectrum1d or a stack of spectra of shape (N, W)
+        :type queries: numpy.ndarray
+        :returns: abundances (ndarray): shape (N, number of references)
+
+        '''
+        return self._queries(queries) @ self._index['pinv']
+
+    def save(self, filename):
+        '''Saves the references (not the index) to a .npz file.
+
+        '''
+        assert self._spectra, 'Library is empty.'
+        np.savez(filename, names=np.array(self.names), spectra=np.stack(self._spectra))
+
+    @classmethod
+    def load(cls, filename, cache=None):
+        '''Loads and builds a library saved with save.
+
+        :params filename: The .npz file
+        :type filename: str
+        :params cache: The index cache file, see build
+        :type cache: str
+        :returns: library (Library)
+
+        '''
+        library = cls()
+        with np.load(filename) as npz:
+            for name, spectrum1d in zip(npz['names'], npz['spectra']):
+                library.add(str(name), spectrum1d)
+        library.build(cache)
+        return library
+
+    def _queries(self, queries):
+        assert self._index is not None, 'Library must be built before matching.'
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        assert queries.shape[1] == self.spectra.shape[1], 'Queries must have the length of the references.'
+        return queries
+
+    def _checksum(self):
+        digest = hashlib.sha1(self.spectra.tobytes())
+        digest.update('\n'.join(self.names).encode())
+        return digest.hexdigest()
+
+
+def _unit_rows(matrix):
+    '''Scales the rows of matrix to unit length (zero rows stay zero).
+
+    '''
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return (matrix / np.where(norms > 0, norms, 1)).astype(np.float32)
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+'''
+Peak detection and line fitting on processed 1d spectra.
+
+All functions accept a single spectrum (shape (W,)) or a stack of spectra
+(shape (N, W)) and work on all peaks of all spectra at once.
+Fits use the linearized least squares forms of the line profiles
+(log-parabola for Gaussian, reciprocal parabola for Lorentzian lines),
+which have a closed form solution and need no iterations.
+
+'''
+import numpy as np
+
+
+GAUSSIAN_FWHM = 2 * np.sqrt(2 * np.log(2))
+
+
+def find_peaks(data, threshold=0, distance=1):
+    '''Finds local maxima.
+
+    A pixel is a peak if it is the maximum within +-distance pixels,
+    larger than its left neighbour (to report plateaus only once)
+    and at least threshold. The first pixel has no left neighbour and
+    must be larger than its right neighbour instead, so a spectrum
+    starting flat does not report a peak at 0.
+
+    :params data: A spectrum1d or a stack of spectra
+    :type data: numpy.ndarray
+    :params threshold: Minimum peak value
+    :type threshold: int or float
+    :params distance: Minimum distance between peaks in pixels
+    :type distance: int
+    :returns: peaks (ndarray or list of ndarrays): peak indices per spectrum
+    :raises: AssertionError
+
+    '''
+    assert isinstance(distance, int) and distance >= 1, 'distance must be a positive int.'
+
+    data = np.asarray(data)
+    stack = np.atleast_2d(data)
+    padded = np.pad(stack, ((0, 0), (distance, distance)), mode='constant',
+                    constant_values=np.min(stack))
+    window = np.lib.stride_tricks.sliding_window_view(padded, 2 * distance + 1, axis=-1)
+    local_max = window.max(axis=-1)
+
+    is_peak = (stack == local_max) & (stack >= threshold)
+    is_peak[:, 1:] &= stack[:, 1:] > stack[:, :-1]
+    if stack.shape[1] > 1:
+        is_peak[:, 0] &= stack[:, 0] > stack[:, 1]
+
+    peaks = [np.flatnonzero(row) for row in is_peak]
+    if data.ndim == 1:
+        return peaks[0]
+    return peaks
+
+
+def centroid(data, positions, half_width=3):
+    '''Calculates the sub-pixel centroid of peaks.
+
+    The centroid is the center of mass of the window around each position
+    after subtracting the window minimum.
+
+    :params data: A spectrum1d or a stack of spectra
+    :type data: numpy.ndarray
+    :params positions: Peak positions, shape (P,) or (N, P)
+    :type positions: numpy.ndarray
+    :params half_width: Half width of the window in pixels
+    :type half_width: int
+    :returns: centers (ndarray): sub-pixel peak centers, same shape as positions
+
+    '''
+    x, y, single = _windows(data, positions, half_width)
+    y = y - y.min(axis=-1, keepdims=True)
+    total = y.sum(axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        centers = (x * y).sum(axis=-1) / total
+    centers[total == 0] = np.nan
+    return centers[0] if single else centers
+
+
+def fit_peaks(data, positions, half_width=5, profile='gaussian'):
+    '''Fits line profiles to peaks.
+
+    The baseline is taken from the window edges, so the window should
+    reach into the line wings (half_width of about two FWHM),
+    otherwise amplitude and width are underestimated.
+
+    :params data: A spectrum1d or a stack of spectra
+    :type data: numpy.ndarray
+    :params positions: Peak positions, shape (P,) or (N, P)
+    :type positions: numpy.ndarray
+    :params half_width: Half width of the fit window in pixels
+    :type half_width: int
+    :params profile: One of gaussian or lorentzian
+    :type profile: str
+    :returns: amplitude, center, fwhm (ndarrays): same shape as positions,
+        nan where the fit failed
+    :raises: AssertionError
+
+    '''
+    assert profile in ('gaussian', 'lorentzian'), 'Unknown profile: {}'.format(profile)
+    assert isinstance(half_width, int) and half_width >= 1, 'half_width must be a positive int.'
+
+    x, y, single = _windows(data, positions, half_width)
+    origin = x[..., half_width:half_width + 1]
+    x = x - origin
+
+    # Baseline from the window edges, the fit only sees the line itself
+    baseline = np.minimum(y[..., :1], y[..., -1:])
+    y = y - baseline
+    valid = y > 0
+    y = np.where(valid, y, 1)
+
+    if profile == 'gaussian':
+        z = np.log(y)
+        w = np.where(valid, y ** 2, 0)
+    else:
+        z = 1 / y
+        w = np.where(valid, y ** 4, 0)
+
+    a, b, c = _weighted_parabola(x, z, w)
+
+    with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+        center = -b / (2 * c)
+        vertex = a - b ** 2 / (4 * c)
+        if profile == 'gaussian':
+            ok = c < 0
+            amplitude = np.exp(vertex)
+            fwhm = GAUSSIAN_FWHM * np.sqrt(-1 / (2 * c))
+        else:
+            ok = (c > 0) & (vertex > 0)
+            amplitude = 1 / vertex
+            fwhm = 2 * np.sqrt(vertex / c)
+
+    ok &= np.abs(center) <= half_width
+    center = center + origin[..., 0]
+    results = []
+    for value in (amplitude, center, fwhm):
+        value = np.where(ok, value, np.nan)
+        results.append(value[0] if single else value)
+    return tuple(results)
+
+
+class PeakTracker(object):
+    '''Tracks peaks between successive spectra.
+
+    Each update fits the lines in windows placed at the centers found
+    in the previous spectrum, so no peak search is needed while the
+    lines move less than half_width pixels per frame.
+    Lost peaks (failed fits) keep their last known position.
+
+    :params positions: Initial peak positions (e.g. from find_peaks)
+    :type positions: numpy.ndarray
+    :params half_width: Half width of the fit window in pixels
+    :type half_width: int
+    :params profile: One of gaussian or lorentzian
+    :type profile: str
+
+    '''
+
+    def __init__(self, positions, half_width=5, profile='gaussian'):
+        self.centers = np.asarray(positions, dtype=np.float64).copy()
+        self.half_width = half_width
+        self.profile = profile
+        self.amplitude = np.full(self.centers.shape, np.nan)
+        self.fwhm = np.full(self.centers.shape, np.nan)
+
+    def update(self, spectrum1d):
+        '''Fits the tracked peaks in a new spectrum.
+
+        Peaks which moved by more than half a pixel are fitted a second
+        time with the window centered on the new position.
+
+        :params spectrum1d: The new spectrum
+        :type spectrum1d: numpy.ndarray
+        :returns: amplitude, center, fwhm (ndarrays)
+
+        '''
+        amplitude, center, fwhm = fit_peaks(spectrum1d, self.centers,
+                                            self.half_width, self.profile)
+        moved = np.abs(center - self.centers) > 0.5
+        if np.any(moved):
+            refit = fit_peaks(spectrum1d, center[moved], self.half_width, self.profile)
+            amplitude[moved], center[moved], fwhm[moved] = refit
+
+        found = ~np.isnan(center)
+        self.centers[found] = center[found]
+        self.amplitude = amplitude
+        self.fwhm = fwhm
+        return amplitude, center, fwhm
+
+
+def _windows(data, positions, half_width):
+    '''Gathers the pixel windows around positions.
+
+    :returns: x, y (ndarrays): pixel indices and values of shape (N, P, 2*half_width+1),
+        single (bool): True if data was a single spectrum
+
+    '''
+    data = np.asarray(data)
+    single = data.ndim == 1
+    stack = np.atleast_2d(data).astype(np.float64, copy=False)
+    positions = np.asarray(positions, dtype=np.float64)
+    if positions.ndim < 2:
+        positions = np.broadcast_to(positions, (stack.shape[0],) + positions.shape)
+
+    offsets = np.arange(-half_width, half_width + 1)
+    centers = np.nan_to_num(np.rint(positions)).astype(np.intp)
+    x = np.clip(centers[..., None] + offsets, 0, stack.shape[-1] - 1)
+    y = np.take_along_axis(stack[:, None, :], x, axis=-1)
+    return x.astype(np.float64), y, single
+
+
+def _weighted_parabola(x, z, w):
+    '''Solves the weighted least squares fit z = a + b*x + c*x**2 for all windows.
+
+    :returns: a, b, c (ndarrays): nan where the system is singular
+
+    '''
+    # Scale the weights so the singularity check does not depend on the signal level
+    scale = w.max(axis=-1, keepdims=True)
+    w = w / np.where(scale > 0, scale, 1)
+
+    sums = [np.sum(w * x ** k, axis=-1) for k in range(5)]
+    rhs = [np.sum(w * z * x ** k, axis=-1) for k in range(3)]
+
+    matrix = np.stack([np.stack(sums[i:i + 3], axis=-1) for i in range(3)], axis=-2)
+    vector = np.stack(rhs, axis=-1)
+
+    singular = np.abs(np.linalg.det(matrix)) < 1e-12
+    matrix[singular] = np.eye(3)
+    solution = np.linalg.solve(matrix, vector[..., None])[..., 0]
+    solution[singular] = np.nan
+    return solution[..., 0], solution[..., 1], solution[..., 2]
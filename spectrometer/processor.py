@@ -3,58 +3,102 @@
 
 TODO: see comments below
 
+cv2, matplotlib and pickle are imported where they are used, so importing
+this module does not pay their import time.
+
+Decoded images are cached in memory (the last CACHE_SIZE images) and
+optionally as .npy files in a cache directory. Cache entries are keyed by
+path, modification time and size of the file and the decoding options,
+so changed files are decoded again.
+
 '''
-import cv2
-import matplotlib.pyplot as plt
+import collections
+import hashlib
 import numpy as np
 import os.path
-import pickle
 import sys
 
+from tiling import threshold_reduce
+
+
+CACHE_SIZE = 32
+
+# Region (top, bottom, left, right) of the spectrum in frames of the 1080p webcam
+ROI_1080P = (300, 500, 1000, 1920)
+
+# {key: decoded image}, least recently used first
+_image_cache = collections.OrderedDict()
+
 
 class Processor(object):
-    def __init__(self):
-        pass
+    '''Processes recorded spectra.
+
+    :params cache_dir: Directory for decoded images, reused by later runs (None: memory only)
+    :type cache_dir: str
+
+    '''
 
-    def load(self, filename):
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir
+        if cache_dir and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def load(self, filename, gray=False, reduce=1, roi=None):
         '''Loads the spectrum data.
         
         Possible input files are pickle files, saved numpy arrays
-        or images files (jpg or png).
+        or images files (jpg, png or tiff) of any resolution.
+        png and tiff files keep their bit depth, alpha channels are dropped.
+
+        Images can be decoded directly to grayscale and reduced in size by
+        the decoder (jpg files are decoded at lower resolution, which is much
+        faster). Both options yield 8 bit images.
+        With roi only the region is kept, the full image is not cached.
+        The roi is given in pixels of the full resolution image, it is
+        scaled for reduced images like the roi of process.
 
         :params filename: The pickle filename.
         :type filename: str
+        :params gray: If true decode images to grayscale
+        :type gray: bool
+        :params reduce: Reduce image resolution by 1, 2, 4 or 8 while decoding
+        :type reduce: int
+        :params roi: Keep only the region (top, bottom, left, right) of images, in full resolution pixels
+        :type roi: tuple
         :returns: None
         :raises: AssertionError, pickle.UnpicklingError
 
         '''
         assert os.path.isfile(filename)
+        assert reduce in (1, 2, 4, 8), 'reduce must be 1, 2, 4 or 8.'
 
+        self.reduce = 1
         name, ext = os.path.splitext(filename)
         if ext == '.pk':
+            import pickle
             with open(filename, 'rb') as outf:
                 self.data = pickle.load(outf)
                 return
         elif ext == '.npy':
             self.data = np.load(filename)
-        elif ext in ['.jpg', '.png']:
-            data = cv2.imread(filename)
-            # TODO
-            # This is just for now and should be removed when you have more data to test
-            if data.shape == (1080, 1920, 3):
-                self.data = cv2.cvtColor(data, cv2.COLOR_BGR2RGB)
-            elif data.shape == (480, 640, 3):
-                self.data = data
+        elif ext in ['.jpg', '.png', '.tif', '.tiff']:
+            self.data = self._load_image(filename, gray, reduce, roi)
+            self.reduce = reduce
         else:
             sys.exit('Unknown file format.')
 
-    def process(self, threshold):
+    def process(self, threshold, roi=None):
         '''Calculates the spectrum.
 
         At the moment the passed array is converted to grayscale and masked
         with the value of threshold.
         Returned spectra are not calibrated.
-        At the moment the roi is hard coded.
+        The roi is given in pixels of the full resolution image, it is
+        scaled for images loaded with reduce, as the roi of load. For an
+        image loaded with a roi it is relative to that region.
+        By default 1920x1080 frames are cropped to ROI_1080P, the spectrum
+        of the 1080p webcam, other data is processed as a whole.
+        Pass (0, None, 0, None) to process a whole 1920x1080 frame.
 
         Steps that should be implemented:
             0. color space and resolution? 8bit? 10bit?
@@ -66,22 +110,71 @@ class Processor(object):
 
         :params threshold: Value to mask the array with
         :type threshold: int
+        :params roi: Only process the region (top, bottom, left, right), in full resolution pixels
+        :type roi: tuple
         :returns: None
 
         '''
         assert isinstance(threshold, int), 'Threshold must be of type int.'
         assert hasattr(self, 'data'), 'Data not found.'
 
-        if self.data.shape == (1080, 1920, 3):
-            roi = self.data[300:500, 1000:]
-            gray = cv2.cvtColor(roi, cv2.COLOR_BGR2GRAY)
-        else:
-            gray = self.data
-            roi = self.data.shape
-        self.spectrum2d = np.where(gray >= threshold, gray, 0)
-        self.spectrum1d = np.sum(self.spectrum2d, axis=0)
+        if roi is None and self.data.shape[:2] == (1080, 1920):
+            roi = ROI_1080P
+        data = self.data
+        if roi is not None:
+            top, bottom, left, right = _scale_roi(roi, self.reduce)
+            data = data[top:bottom, left:right]
+        self.spectrum2d, self.spectrum1d = threshold_reduce(data, threshold)
         self.threshold = threshold
 
+    def _load_image(self, filename, gray, reduce, roi):
+        '''Decodes an image or returns it from the cache.
+
+        :returns: data (ndarray): read only, BGR or grayscale
+
+        '''
+        import cv2
+
+        if gray:
+            flags = {1: cv2.IMREAD_GRAYSCALE, 2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+                     4: cv2.IMREAD_REDUCED_GRAYSCALE_4, 8: cv2.IMREAD_REDUCED_GRAYSCALE_8}[reduce]
+        else:
+            # Keeps 16 bit and single channel images as they are, drops alpha channels
+            flags = {1: cv2.IMREAD_ANYDEPTH | cv2.IMREAD_ANYCOLOR, 2: cv2.IMREAD_REDUCED_COLOR_2,
+                     4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}[reduce]
+
+        stat = os.stat(filename)
+        # roi may be a list (e.g. from json), the key must be hashable
+        roi = None if roi is None else tuple(roi)
+        key = (os.path.abspath(filename), stat.st_mtime_ns, stat.st_size, flags, roi)
+        if key in _image_cache:
+            _image_cache.move_to_end(key)
+            return _image_cache[key]
+
+        cache_file = None
+        if self.cache_dir:
+            digest = hashlib.sha1(repr(key).encode()).hexdigest()
+            cache_file = os.path.join(self.cache_dir, digest + '.npy')
+
+        if cache_file and os.path.isfile(cache_file):
+            data = np.load(cache_file)
+        else:
+            data = cv2.imread(filename, flags)
+            assert data is not None, 'Could not decode {}'.format(filename)
+            if roi is not None:
+                top, bottom, left, right = _scale_roi(roi, reduce)
+                # Copy, so the full decoded image is freed
+                data = data[top:bottom, left:right].copy()
+            if cache_file:
+                np.save(cache_file, data)
+
+        # Cached arrays are shared between loads and must not be modified
+        data.flags.writeable = False
+        _image_cache[key] = data
+        if len(_image_cache) > CACHE_SIZE:
+            _image_cache.popitem(last=False)
+        return data
+
     def show(self):
         '''Plots the processed spectra.
 
@@ -92,6 +185,7 @@ class Processor(object):
         assert hasattr(self, 'spectrum2d'), 'Data must be processed before plotting.'
         assert hasattr(self, 'threshold'), 'Data must be processed before plotting.'
 
+        import matplotlib.pyplot as plt
         from matplotlib import gridspec
         fig = plt.figure()
         grid = gridspec.GridSpec(2, 1, height_ratios=[1, 1])
@@ -116,11 +210,7 @@ class Processor(object):
     def write(self, filename):
         '''Writes the processed 1d spectrum to a text file.
 
-        The format is specified by the filename extension.
-        Currently supported formats are:
-            - csv: Writes a file with values seperated by comma.
-            - xy: Write a file with values seperated by two spaces.
-            - dat: Same as xy.
+        See write_spectrum1d for the formats.
 
         :params filename: Name of file
         :type filename: str
@@ -128,26 +218,53 @@ class Processor(object):
 
         '''
         assert hasattr(self, 'spectrum1d'), 'One dimensional data not found.'
-        assert isinstance(filename, str), 'Incorrect filename.'
-
-        ext = filename.split('.')[-1]
-        if ext == 'csv':
-            header = '"Pixel", "Value"\n'
-            seperator = ','
-        elif ext in ['xy', 'dat']:
-            header = '# x  y\n'
-            seperator = '  '
-        else:
-            string = 'WARNING: Unknown file format: .{}. No output written.'.format(ext)
-            print('\033[93m' + string + '\033[0m')
-            return
 
-        with open(filename, 'w') as outf:
-            outf.write(header)
-            for pixel, value in enumerate(self.spectrum1d):
-                outf.write('{}{}{}\n'.format(pixel, seperator, value))
+        write_spectrum1d(self.spectrum1d, filename)
+
+
+def _scale_roi(roi, reduce):
+    '''Converts a roi in full resolution pixels to pixels of an image reduced by reduce.
+
+    '''
+    return tuple(None if value is None else value // reduce for value in roi)
+
+
+def write_spectrum1d(spectrum1d, filename):
+    '''Writes a 1d spectrum to a text file.
+
+    The format is specified by the filename extension.
+    Currently supported formats are:
+        - csv: Writes a file with values seperated by comma.
+        - xy: Write a file with values seperated by two spaces.
+        - dat: Same as xy.
+
+    :params spectrum1d: The spectrum
+    :type spectrum1d: numpy.ndarray
+    :params filename: Name of file
+    :type filename: str
+    :returns: None
+
+    '''
+    assert isinstance(filename, str), 'Incorrect filename.'
+
+    ext = filename.split('.')[-1]
+    if ext == 'csv':
+        header = '"Pixel", "Value"\n'
+        seperator = ','
+    elif ext in ['xy', 'dat']:
+        header = '# x  y\n'
+        seperator = '  '
+    else:
+        string = 'WARNING: Unknown file format: .{}. No output written.'.format(ext)
+        print('\033[93m' + string + '\033[0m')
+        return
+
+    with open(filename, 'w') as outf:
+        outf.write(header)
+        for pixel, value in enumerate(spectrum1d):
+            outf.write('{}{}{}\n'.format(pixel, seperator, value))
 
-        print('Output written to file: {}'.format(filename))
+    print('Output written to file: {}'.format(filename))
 
 
 if __name__ == '__main__':
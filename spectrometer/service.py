@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+'''
+Headless measurement service.
+
+The service keeps one Spectrometer open (and its camera warm) and serves
+requests from local clients over TCP. Each request and each reply is one
+line of json:
+
+    {"command": "measure", "kind": "spectrum", "num_frames": 10,
+     "num_dropped_frames": 10, "name": "sample", "threshold": 10}
+    {"status": "ok", "name": "sample", "kind": "spectrum", "num_frames": 10,
+     "spectrum1d": [...]}
+
+Commands:
+    - ping: Returns {"status": "ok"}.
+    - measure: Measures and processes a background or spectrum.
+    - stream: Measures count single frame spectra, one reply line per spectrum,
+      followed by {"status": "done"}.
+    - process: Processes a file on the service host with Processor.
+    - shutdown: Stops the service.
+
+Requests of all clients are put in one queue and executed one after
+another by a single worker thread, which owns the spectrometer.
+
+Start the service with:
+
+    python service.py --port 50505
+
+'''
+import json
+import queue
+import socket
+import socketserver
+import threading
+
+from processor import Processor
+
+
+DEFAULT_PORT = 50505
+
+
+class Service(object):
+    '''Owns the spectrometer and executes queued requests.
+
+    :params spectrometer: The spectrometer to measure with
+    :type spectrometer: spectrometer.Spectrometer
+    :params host: The interface to listen on (local only by default)
+    :type host: str
+    :params port: The tcp port
+    :type port: int
+
+    '''
+
+    def __init__(self, spectrometer, host='127.0.0.1', port=DEFAULT_PORT):
+        self.spectrometer = spectrometer
+        self.jobs = queue.Queue()
+        self.server = _Server((host, port), _Handler)
+        self.server.service = self
+        self.worker = threading.Thread(target=self._work, name='measurement worker')
+        self.worker.daemon = True
+
+    def serve_forever(self):
+        '''Serves requests until a shutdown request is received.
+
+        '''
+        print('Serving on {}:{}'.format(*self.server.server_address))
+        self.worker.start()
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+
+    def submit(self, request):
+        '''Queues a request.
+
+        :params request: The decoded request
+        :type request: dict
+        :returns: replies (queue.Queue): receives the reply dicts, None marks the end
+
+        '''
+        replies = queue.Queue()
+        self.jobs.put((request, replies))
+        return replies
+
+    def _work(self):
+        while True:
+            request, replies = self.jobs.get()
+            try:
+                for reply in self._execute(request):
+                    replies.put(reply)
+            except (Exception, SystemExit) as error:
+                # Report every failure to the client, the worker must keep running
+                replies.put({'status': 'error', 'message': '{}: {}'.format(type(error).__name__, error)})
+            replies.put(None)
+
+    def _execute(self, request):
+        '''Executes a request.
+
+        :returns: generator of reply dicts
+
+        '''
+        command = request.get('command')
+        if command == 'ping':
+            yield {'status': 'ok'}
+        elif command == 'measure':
+            yield self._measure(request)
+        elif command == 'stream':
+            count = request.get('count', 1)
+            assert isinstance(count, int) and count > 0, 'count must be a positive int.'
+            request = dict(request, kind='spectrum', num_frames=1, num_dropped_frames=0)
+            for i in range(count):
+                yield self._measure(request)
+            yield {'status': 'done'}
+        elif command == 'process':
+            processor = Processor()
+            processor.load(request['filename'])
+            processor.process(request.get('threshold', 10), request.get('roi'))
+            yield {'status': 'ok', 'spectrum1d': processor.spectrum1d.tolist()}
+        elif command == 'shutdown':
+            yield {'status': 'ok'}
+            # shutdown blocks until serve_forever returns, so it must not run in the worker
+            threading.Thread(target=self.server.shutdown).start()
+        else:
+            yield {'status': 'error', 'message': 'Unknown command: {}'.format(command)}
+
+    def _measure(self, request):
+        kind = request.get('kind', 'spectrum')
+        assert kind in ('spectrum', 'background'), 'kind must be spectrum or background.'
+
+        spec = self.spectrometer.measure(request['num_frames'], request['num_dropped_frames'], kind,
+                                         name=request.get('name', kind))
+        spec.process(request.get('threshold', 10))
+        return {
+            'status': 'ok',
+            'name': spec.name,
+            'kind': spec.kind,
+            'num_frames': spec.num_frames,
+            'spectrum1d': spec.spectrum1d.tolist(),
+        }
+
+
+class _Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    '''Reads request lines of one client and writes the replies.
+
+    '''
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line.decode())
+            except ValueError:
+                self._send({'status': 'error', 'message': 'Invalid json.'})
+                continue
+
+            replies = self.server.service.submit(request)
+            reply = replies.get()
+            while reply is not None:
+                self._send(reply)
+                reply = replies.get()
+
+    def _send(self, reply):
+        self.wfile.write(json.dumps(reply).encode() + b'\n')
+
+
+class Client(object):
+    '''Connects to a running service.
+
+    Example:
+        client = Client()
+        background = client.measure(10, 10, kind='background')
+        spectrum = client.measure(10, 10, name='sample')
+
+    :params host: The service host
+    :type host: str
+    :params port: The service port
+    :type port: int
+
+    '''
+
+    def __init__(self, host='127.0.0.1', port=DEFAULT_PORT):
+        self.sock = socket.create_connection((host, port))
+        self.file = self.sock.makefile('rwb')
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+    def request(self, command, **kwargs):
+        '''Sends a request and returns the first reply.
+
+        :params command: The command name
+        :type command: str
+        :returns: reply (dict)
+        :raises: RuntimeError if the service replies with an error
+
+        '''
+        self._send(command, **kwargs)
+        return self._receive()
+
+    def ping(self):
+        return self.request('ping')
+
+    def measure(self, num_frames, num_dropped_frames, kind='spectrum', **kwargs):
+        '''Measures on the service. See Spectrometer.measure.
+
+        :params threshold: Threshold for processing (default 10)
+        :type threshold: int
+        :params name: The spectrum name
+        :type name: str
+        :returns: reply (dict): with name, kind, num_frames and spectrum1d
+
+        '''
+        return self.request('measure', num_frames=num_frames, num_dropped_frames=num_dropped_frames,
+                            kind=kind, **kwargs)
+
+    def process(self, filename, threshold=10, roi=None):
+        return self.request('process', filename=filename, threshold=threshold, roi=roi)
+
+    def stream(self, count, threshold=10):
+        '''Yields count single frame spectra.
+
+        '''
+        self._send('stream', count=count, threshold=threshold)
+        reply = self._receive()
+        while reply['status'] != 'done':
+            yield reply
+            reply = self._receive()
+
+    def shutdown(self):
+        return self.request('shutdown')
+
+    def _send(self, command, **kwargs):
+        kwargs['command'] = command
+        self.file.write(json.dumps(kwargs).encode() + b'\n')
+        self.file.flush()
+
+    def _receive(self):
+        reply = json.loads(self.file.readline().decode())
+        if reply['status'] == 'error':
+            raise RuntimeError(reply['message'])
+        return reply
+
+
+if __name__ == '__main__':
+    import argparse
+    from spectrometer import Spectrometer
+
+    parser = argparse.ArgumentParser(description='Serve spectrometer measurements.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--detector', type=int, default=0)
+    args = parser.parse_args()
+
+    Service(Spectrometer(detector=args.detector), args.host, args.port).serve_forever()
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+'''
+Reusable camera capture sessions.
+
+Opening a webcam and waiting for its auto exposure to settle takes seconds.
+A session keeps the capture open between measurements, so every Detector
+on the same device shares one warm capture (see get_session).
+
+The pixel format (see Detector capture modes) is state of the shared
+capture, every detector requests its format with set_format before
+measuring, so detectors with different modes can share a device.
+
+Exposure, gain and white balance can be pinned to fixed values. Once a
+pinned session has settled, further measurements start without dropping
+any frames. Without pinning, settle() drops frames only until the mean
+brightness stops changing.
+
+'''
+import cv2
+
+
+# The V4L2 backend maps 0.25 to manual exposure and 0.75 to aperture priority (auto)
+AUTO_EXPOSURE_MANUAL = 0.25
+AUTO_EXPOSURE_AUTO = 0.75
+
+# {device: session}
+_sessions = {}
+
+
+def get_session(device):
+    '''Returns the session of device, opening it on first use.
+
+    :params device: the X in /dev/videoX
+    :type device: int
+    :returns: session (CaptureSession)
+
+    '''
+    if device not in _sessions:
+        _sessions[device] = CaptureSession(device)
+    return _sessions[device]
+
+
+def release_all():
+    '''Releases all pooled sessions.
+
+    '''
+    for session in _sessions.values():
+        session.release()
+    _sessions.clear()
+
+
+class CaptureSession(object):
+    '''An open video capture and its exposure state.
+
+    :params device: the X in /dev/videoX
+    :type device: int
+    :params cap: an already opened capture (e.g. for testing), opened from device if None
+    :type cap: cv2.VideoCapture
+    :params settled: True once the brightness was found stable
+    :type settled: bool
+    :params pinned: the pinned camera properties {cv2.CAP_PROP_*: value}
+    :type pinned: dict
+    :params fourcc: the requested pixel format, None for the camera default (BGR)
+    :type fourcc: str
+
+    '''
+
+    def __init__(self, device, cap=None):
+        self.device = device
+        self.cap = cap if cap is not None else cv2.VideoCapture(device)
+        self.settled = False
+        self.pinned = {}
+        self.fourcc = None
+        self.default_fourcc = int(self.cap.get(cv2.CAP_PROP_FOURCC))
+
+    def ensure_open(self):
+        '''Reopens the capture if it was released and restores pinned properties.
+
+        '''
+        if self.cap.isOpened():
+            return
+        self.cap.open(self.device)
+        self.settled = False
+        if self.fourcc is not None:
+            self.cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*self.fourcc))
+            self.cap.set(cv2.CAP_PROP_CONVERT_RGB, 0)
+        for prop, value in self.pinned.items():
+            self.cap.set(prop, value)
+
+    def set_format(self, fourcc):
+        '''Requests a pixel format from the camera.
+
+        :params fourcc: the four character code (e.g. GREY), None restores
+            the camera's default format with conversion to BGR
+        :type fourcc: str
+        :returns: supported (bool): False if the camera kept another format
+
+        '''
+        self.ensure_open()
+        if fourcc == self.fourcc:
+            return True
+
+        if fourcc is None:
+            self.cap.set(cv2.CAP_PROP_FOURCC, self.default_fourcc)
+            self.cap.set(cv2.CAP_PROP_CONVERT_RGB, 1)
+        else:
+            self.cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*fourcc))
+            self.cap.set(cv2.CAP_PROP_CONVERT_RGB, 0)
+        self.fourcc = fourcc
+        self.settled = False
+        return fourcc is None or int(self.cap.get(cv2.CAP_PROP_FOURCC)) == cv2.VideoWriter_fourcc(*fourcc)
+
+    def read(self):
+        '''Reads a frame.
+
+        :returns: ret (bool), frame (ndarray)
+
+        '''
+        return self.cap.read()
+
+    def pin(self, exposure=None, gain=None, white_balance=None):
+        '''Disables the camera's automatic exposure, gain and white balance.
+
+        Properties which are not given are pinned to the camera's current value,
+        so calling pin() after a settled measurement freezes that state.
+
+        :params exposure: exposure value (camera specific units)
+        :type exposure: float
+        :params gain: gain value
+        :type gain: float
+        :params white_balance: white balance temperature in Kelvin
+        :type white_balance: float
+        :returns: None
+
+        '''
+        self.ensure_open()
+        if exposure is None:
+            exposure = self.cap.get(cv2.CAP_PROP_EXPOSURE)
+        if gain is None:
+            gain = self.cap.get(cv2.CAP_PROP_GAIN)
+        if white_balance is None:
+            white_balance = self.cap.get(cv2.CAP_PROP_WB_TEMPERATURE)
+
+        # The automatic modes must be switched off before the values are accepted
+        self.pinned = {
+            cv2.CAP_PROP_AUTO_EXPOSURE: AUTO_EXPOSURE_MANUAL,
+            cv2.CAP_PROP_AUTO_WB: 0,
+            cv2.CAP_PROP_EXPOSURE: exposure,
+            cv2.CAP_PROP_GAIN: gain,
+            cv2.CAP_PROP_WB_TEMPERATURE: white_balance,
+        }
+        for prop, value in self.pinned.items():
+            self.cap.set(prop, value)
+        self.settled = False
+
+    def unpin(self):
+        '''Enables automatic exposure and white balance again.
+
+        '''
+        self.pinned = {}
+        self.cap.set(cv2.CAP_PROP_AUTO_EXPOSURE, AUTO_EXPOSURE_AUTO)
+        self.cap.set(cv2.CAP_PROP_AUTO_WB, 1)
+        self.settled = False
+
+    def settle(self, max_frames, tolerance=0.01, stable_frames=3):
+        '''Drops frames until the mean brightness is stable.
+
+        A pinned session which has settled once returns immediately.
+        Otherwise frames are dropped until the mean brightness of
+        stable_frames consecutive frames stays within tolerance (relative
+        change between frames), but at most max_frames frames.
+        With 0 < max_frames < stable_frames the session can not settle,
+        a warning is printed.
+
+        :params max_frames: maximum number of dropped frames
+        :type max_frames: int
+        :params tolerance: relative brightness change regarded as stable
+        :type tolerance: float
+        :params stable_frames: number of consecutive stable frames
+        :type stable_frames: int
+        :returns: dropped (int): the number of dropped frames
+
+        '''
+        self.ensure_open()
+        if self.settled and self.pinned:
+            return 0
+
+        previous = None
+        stable = 0
+        for dropped in range(1, max_frames + 1):
+            ret, frame = self.cap.read()
+            if not ret:
+                stable = 0
+                continue
+
+            # A sparse grid of pixels is enough to follow the exposure
+            brightness = float(frame[::8, ::8].mean())
+            if previous is not None and abs(brightness - previous) <= tolerance * max(previous, 1.0):
+                stable += 1
+            else:
+                # The first frame of a stable run counts as well
+                stable = 1
+            previous = brightness
+
+            if stable >= stable_frames:
+                self.settled = True
+                return dropped
+
+        if 0 < max_frames < stable_frames:
+            string = 'WARNING: {} stable frames are needed to settle, at most {} are dropped.'.format(
+                stable_frames, max_frames)
+            print('\033[93m' + string + '\033[0m')
+        return max_frames
+
+    def release(self):
+        '''Closes the capture of all detectors using the session.
+
+        The next measurement of any of them reopens it.
+
+        '''
+        self.cap.release()
+        self.settled = False
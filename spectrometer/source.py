@@ -25,7 +25,6 @@ The code running on the arduino should look something like this:
 '''
 import os.path
 import sys
-import serial
 
 
 class Source(object):
@@ -63,6 +62,8 @@ class Source(object):
 
         '''
         if self.device:
+            # pyserial is only needed when a source is actually connected
+            import serial
             self.connection = serial.Serial(self.device)
         else:
             print('\033[93m' + 'WARNING: No serial device selected.' + '\033[0m')
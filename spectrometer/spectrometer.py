@@ -1,8 +1,6 @@
 # -*- coding: utf-8 -*-
-import serial
 import sys
 from detector import Detector
-from source import Source
 
 
 class Spectrometer(object):
@@ -28,6 +26,8 @@ class Spectrometer(object):
         assert isinstance(source, str)
         assert isinstance(detector, int)
 
+        # Imported here, so the serial dependency is only loaded with a source
+        from source import Source
         self.source = Source(source)
         self.detector = Detector(detector)
 
@@ -40,15 +40,16 @@ class Spectrometer(object):
         :type num_dropped_frames: int
         :params kind: The type of measurment. Choices are: 'background', 'spectrum', 'stream'
         :type kind: str
+        :returns: spectrum (spectrum.Spectrum): the measured spectrum (None for stream)
 
         '''
         if kind == 'spectrum':
             #self.source_on()
-            self.detector.measure_spectrum(num_frames, num_dropped_frames, **kwargs)
+            return self.detector.measure_spectrum(num_frames, num_dropped_frames, **kwargs)
             #self.source_off()
         elif kind == 'background':
             #self.source_on()
-            self.detector.measure_background(num_frames, num_dropped_frames, **kwargs)
+            return self.detector.measure_background(num_frames, num_dropped_frames, **kwargs)
             #self.source_off()
         elif kind == 'stream':
             #self.source_on()
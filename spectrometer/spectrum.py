@@ -1,17 +1,20 @@
 # -*- coding: utf-8 -*-
 '''
-TODO: Make a satisfying save method. Using jpgs loses spectral depth.
+TODO: Make a satisfying save method. Using jpgs loses spectral depth,
+png and tiff files are written losslessly where the data range allows it.
 Pickling creates huge (up to 100MB) files.
 
+cv2, matplotlib and pickle are imported where they are used, so importing
+this module does not pay their import time.
+
 '''
 import copy
-import cv2
-import matplotlib.pyplot as plt
 import numpy as np
 import os.path
-import pickle
 import sys
 
+from tiling import process_batch, threshold_reduce
+
 
 class Spectrum(object):
     '''This class provides a way to hold and manipulate spectral data.
@@ -19,8 +22,9 @@ class Spectrum(object):
     When spectrum data is read from an image file there is no way to determine
     num_frames and the data value range is restricted to image format limits.
 
-    However, a spectrum recorded with the detector module can fully utilize
-    the 64 bit range and also populates the num_frames attributes.
+    However, a spectrum recorded with the detector module keeps exact sums
+    (float32 stacks are promoted to float64 when they would lose precision)
+    and also populates the num_frames and saturation attributes.
     It is therefore preffered to process a spectrum immediatly
     and use the image file only when in a pinch.
 
@@ -40,6 +44,16 @@ class Spectrum(object):
         :type kind: str
         :params name: The spectrum's name
         :type name: str
+        :params bit_depth: The bit depth of the captured frames (default 8)
+        :type bit_depth: int
+        :params saturation: Number of saturated frames per pixel (None if unknown)
+        :type saturation: numpy.ndarray
+        :params exposure: The camera exposure of the measurement (None if unknown)
+        :type exposure: float
+        :params gain: The camera gain of the measurement (None if unknown)
+        :type gain: float
+        :params timestamp: The time of the measurement in seconds since the epoch (None if unknown)
+        :type timestamp: float
 
         '''
         self.data = None
@@ -47,6 +61,11 @@ class Spectrum(object):
         self.num_frames = -1  # The number of summed frames
         self.kind = kwargs.get('kind', None)  # One of spectrum, background, ...
         self.name = kwargs.get('name', None)
+        self.bit_depth = kwargs.get('bit_depth', 8)
+        self.saturation = None
+        self.exposure = None
+        self.gain = None
+        self.timestamp = None
         self.modified = False  # Track if the original data was modified
 
     def add_data(self, data):
@@ -82,12 +101,18 @@ class Spectrum(object):
         name, ext = os.path.splitext(filename)
         
         if ext == '.pk':
+            import pickle
             with open(filename, 'rb') as outf:
                 data = pickle.load(outf)
         elif not ext or ext == '.npy':
             data = np.load(filename)
-        elif ext in ['.jpg', '.png']:
+        elif ext == '.jpg':
+            import cv2
             data = cv2.imread(filename)
+        elif ext in ['.png', '.tif', '.tiff']:
+            # Keeps 16 bit, float and single channel images as they are, drops alpha channels
+            import cv2
+            data = cv2.imread(filename, cv2.IMREAD_ANYDEPTH | cv2.IMREAD_ANYCOLOR)
         else:
             sys.exit('Unknown file format')
 
@@ -98,6 +123,11 @@ class Spectrum(object):
         
         The file format is based on the extension.
         If no extension is given a .npy file is written.
+
+        png and tiff files are written as 8 or 16 bit integer images when the
+        data fits without loss. Larger values are written as float32 tiff,
+        png files are scaled to 16 bit with a warning.
+        jpg files are always 8 bit and lossy.
         
         :params filename: The output filename.
         :type filename: str
@@ -112,15 +142,21 @@ class Spectrum(object):
         if not ext or ext == '.npy':
             np.save(filename, self.data)
         elif ext == '.pk':
+            import pickle
             with open(filename, 'wb') as outf:
                 pickle.dump(self.data, outf)
-        elif ext in ['.jpg', '.png']:
+        elif ext == '.jpg':
+            import cv2
             cv2.imwrite(filename, self.data)
+        elif ext in ['.png', '.tif', '.tiff']:
+            import cv2
+            cv2.imwrite(filename, _lossless_image(self.data, ext))
 
     def show_raw(self):
         '''Shows the raw image data.
         
         '''
+        import cv2
         data = self.data.astype('uint8')
         cv2.namedWindow('raw')
         cv2.imshow('raw', data)
@@ -137,6 +173,15 @@ class Spectrum(object):
         Returned spectra are not calibrated.
         At the moment the roi is hard coded.
 
+        Single channel data (mono, 10 or 16 bit captures) is used as is,
+        color data is converted to grayscale first. Large frames are
+        processed in row bands on a thread pool, see tiling.py.
+
+        If the saturation map of the capture is known, saturation2d holds
+        the saturated frames per pixel (maximum over the color channels) and
+        saturated1d the number of pixels per column that were saturated
+        in at least one frame.
+
         Steps that should be implemented:
             0. color space and resolution? 8bit? 10bit?
             1. Subtract dark current and adc noise
@@ -154,12 +199,26 @@ class Spectrum(object):
 
         roi = self.data
 #        roi = self.data[300:500, 1000:]
-        gray = cv2.cvtColor(roi, cv2.COLOR_BGR2GRAY)
-#        gray = self.data
-        self.spectrum2d = np.where(gray >= threshold, gray, 0)
-        self.spectrum1d = np.sum(self.spectrum2d, axis=0)
+        spectrum2d, spectrum1d = threshold_reduce(roi, threshold)
+        self._set_processed(spectrum2d, spectrum1d, threshold)
+
+    def _set_processed(self, spectrum2d, spectrum1d, threshold):
+        '''Sets the results of process and the saturation per column.
+
+        '''
+        self.spectrum2d = spectrum2d
+        self.spectrum1d = spectrum1d
         self.threshold = threshold
 
+        saturation = getattr(self, 'saturation', None)
+        if saturation is not None and saturation.shape[:2] == spectrum2d.shape:
+            self.saturation2d = saturation if saturation.ndim == 2 else saturation.max(axis=2)
+            self.saturated1d = np.count_nonzero(self.saturation2d, axis=0)
+            if self.saturated1d.any():
+                string = 'WARNING: {} pixels in {} columns are saturated.'.format(
+                    int(self.saturated1d.sum()), int(np.count_nonzero(self.saturated1d)))
+                print('\033[93m' + string + '\033[0m')
+
     def show(self):
         '''Plots the processed spectra.
 
@@ -170,6 +229,7 @@ class Spectrum(object):
         assert hasattr(self, 'spectrum2d'), 'Data must be processed before plotting.'
         assert hasattr(self, 'threshold'), 'Data must be processed before plotting.'
 
+        import matplotlib.pyplot as plt
         from matplotlib import gridspec
         fig = plt.figure()
         grid = gridspec.GridSpec(2, 1, height_ratios=[1, 1])
@@ -192,7 +252,7 @@ class Spectrum(object):
         plt.show()
 
     def subtract(self, other):
-        '''Subtract a spectrum or value.
+        '''Subtract a spectrum or value in place.
 
         :params other: The spectrum or value to subtract
         :type other: Either int or spectrum.Spectrum
@@ -203,16 +263,102 @@ class Spectrum(object):
         if isinstance(other, Spectrum):
             assert self.num_frames == other.num_frames, 'Both spectra must have same frame numbers.'
             assert self.data.shape == other.data.shape, 'Data must be of same length.'
-
-            self.data = self.data - other.data
+            other = other.data
         else:
             assert isinstance(other, (int, float))
-            self.data = self.data - other
-            
+
+        np.subtract(self._working_data(), other, out=self.data)
         self.modified = True
 
-    def normalize(self):
-        pass
+    def subtract_dark(self, library, **kwargs):
+        '''Subtract the dark frame of the measurement conditions in place.
+
+        The per frame dark frame of a dark.DarkLibrary is scaled to num_frames.
+
+        :params library: The dark frames
+        :type library: dark.DarkLibrary
+        :params exposure: The exposure (default: the recorded exposure)
+        :type exposure: float
+        :params gain: The gain (default: the recorded gain)
+        :type gain: float
+        :params timestamp: The measurement time (default: timestamp attribute or now)
+        :type timestamp: float
+        :params temperature: The sensor temperature (default: select dark frames by time)
+        :type temperature: float
+        :returns: None
+        :raises: AssertionError
+
+        '''
+        exposure = kwargs.get('exposure', getattr(self, 'exposure', None))
+        gain = kwargs.get('gain', getattr(self, 'gain', None))
+        assert exposure is not None and gain is not None, 'Exposure and gain unknown.'
+        assert self.num_frames > 0, 'num_frames not set.'
+
+        dark = library.dark(exposure, gain, kwargs.get('timestamp', getattr(self, 'timestamp', None)),
+                            kwargs.get('temperature'))
+        assert dark.shape == self.data.shape, 'Dark frame must have the data shape.'
+        data = self._working_data()
+        data -= dark * self.num_frames
+        self.modified = True
+
+    def divide(self, other):
+        '''Divide by a spectrum or value in place.
+
+        Elements where a divisor spectrum is zero are set to zero.
+
+        :params other: The spectrum or value to divide by
+        :type other: Either int, float or spectrum.Spectrum
+        :returns: None
+        :raises: AssertionError
+
+        '''
+        if isinstance(other, Spectrum):
+            assert self.data.shape == other.data.shape, 'Data must be of same length.'
+            other = other.data
+        else:
+            assert isinstance(other, (int, float)), 'other must be a number or a Spectrum.'
+            assert other != 0, 'Division by zero.'
+
+        divide(self._working_data(), other)
+        self.modified = True
+
+    def normalize(self, mode='peak', reference=None):
+        '''Normalizes the spectrum data in place.
+
+        Modes:
+            - peak: Divide by the maximum value.
+            - area: Divide by the sum of all values.
+            - reference: Divide element wise by the data of reference.
+
+        :params mode: One of peak, area or reference
+        :type mode: str
+        :params reference: The reference spectrum (only used with mode reference)
+        :type reference: spectrum.Spectrum
+        :returns: None
+        :raises: AssertionError
+
+        '''
+        if mode == 'reference':
+            assert isinstance(reference, Spectrum), 'reference must be of type Spectrum.'
+            assert self.data.shape == reference.data.shape, 'Data must be of same length.'
+            reference = reference.data
+
+        normalize(self._working_data(), mode, reference)
+        self.modified = True
+
+    def clip_negative(self):
+        '''Sets negative values to zero in place.
+
+        Useful after subtracting a background which is brighter than the
+        spectrum in some pixels.
+
+        :returns: None
+
+        '''
+        if self.data.dtype.kind == 'u':
+            return
+        np.maximum(self.data, 0, out=self.data)
+        self.modified = True
 
     def average(self):
         '''Averages the spectrum data.
@@ -224,17 +370,171 @@ class Spectrum(object):
         :raises: AssertionError
 
         '''
-        assert self.num_frames is not -1, 'num_frames not set.'
+        assert self.num_frames != -1, 'num_frames not set.'
         assert hasattr(self, 'data')
 
-        self.data = self.data / self.num_frames
+        divide(self._working_data(), self.num_frames)
         self.modified = True
 
+    def _working_data(self):
+        '''Returns the data in a dtype suitable for in place arithmetic.
+
+        Integer data (e.g. uint8 images) would under- or overflow, so it
+        is converted once to a floating point type, see working_dtype.
+        Floating point data is returned as is without copying.
+
+        :returns: data (ndarray)
+
+        '''
+        dtype = working_dtype(self.data.dtype)
+        if self.data.dtype != dtype:
+            self.data = self.data.astype(dtype)
+        return self.data
+
+
+def _lossless_image(data, ext):
+    '''Returns data in the smallest image dtype which holds it without loss.
+
+    :params data: The spectrum data
+    :type data: numpy.ndarray
+    :params ext: The image file extension
+    :type ext: str
+    :returns: image (ndarray)
+
+    '''
+    if data.dtype in (np.uint8, np.uint16):
+        return data
+
+    low, high = np.min(data), np.max(data)
+    integral = data.dtype.kind in 'iu' or np.array_equal(data, np.rint(data))
+    if integral and low >= 0 and high <= np.iinfo(np.uint16).max:
+        if high <= np.iinfo(np.uint8).max:
+            return data.astype(np.uint8)
+        return data.astype(np.uint16)
+
+    if ext in ['.tif', '.tiff']:
+        return data.astype(np.float32)
+
+    string = 'WARNING: Data does not fit into 16 bit png and is scaled. Use .tiff or .npy instead.'
+    print('\033[93m' + string + '\033[0m')
+    data = np.clip(data, 0, None)
+    return (data * (np.iinfo(np.uint16).max / max(high, 1))).astype(np.uint16)
+
+
+def working_dtype(dtype):
+    '''Returns the floating point dtype used for arithmetic on dtype.
+
+    8 and 16 bit integers fit exactly into float32, wider integers
+    need float64. Floating point types are kept.
+
+    :params dtype: The dtype of the data
+    :type dtype: numpy.dtype
+    :returns: dtype (numpy.dtype)
+
+    '''
+    dtype = np.dtype(dtype)
+    if dtype.kind == 'f':
+        return dtype
+    if dtype.itemsize <= 2:
+        return np.dtype(np.float32)
+    return np.dtype(np.float64)
+
+
+def divide(data, divisor):
+    '''Divides data in place.
+
+    Elements where an array divisor is zero are set to zero.
+
+    :params data: The floating point array to divide
+    :type data: numpy.ndarray
+    :params divisor: The divisor
+    :type divisor: numpy.ndarray or number
+    :returns: data (ndarray)
+
+    '''
+    if isinstance(divisor, np.ndarray):
+        zero = divisor == 0
+        np.divide(data, divisor, out=data, where=~zero)
+        data[np.broadcast_to(zero, data.shape)] = 0
+    else:
+        np.divide(data, divisor, out=data)
+    return data
+
+
+def normalize(data, mode='peak', reference=None, axis=None):
+    '''Normalizes a floating point array in place.
+
+    With axis set, every slice along axis is normalized on its own,
+    i.e. a stack of spectra of shape (N, W) is normalized per spectrum
+    with axis=-1.
+
+    :params data: The floating point array to normalize
+    :type data: numpy.ndarray
+    :params mode: One of peak, area or reference
+    :type mode: str
+    :params reference: The divisor array for mode reference
+    :type reference: numpy.ndarray
+    :params axis: The axis to normalize along, None for the whole array
+    :type axis: int
+    :returns: data (ndarray)
+    :raises: AssertionError
+
+    '''
+    assert data.dtype.kind == 'f', 'data must be a floating point array.'
+
+    if mode == 'peak':
+        divisor = np.max(data, axis=axis, keepdims=True)
+    elif mode == 'area':
+        # Accumulate in float64, float32 sums over a full frame lose precision
+        divisor = np.sum(data, axis=axis, dtype=np.float64, keepdims=True)
+    elif mode == 'reference':
+        assert reference is not None, 'reference not set.'
+        divisor = reference
+    else:
+        raise AssertionError('Unknown normalization mode: {}'.format(mode))
+
+    return divide(data, np.asarray(divisor))
+
+
+def batch(spectra, operation, *args, **kwargs):
+    '''Applies a Spectrum method in place to many spectra.
+
+    process runs on a thread pool, one spectrum per task
+    (see tiling.process_batch).
+
+    Example:
+        batch(spectra, 'subtract', background)
+        batch(spectra, 'normalize', mode='area')
+        batch(spectra, 'process', 10)
+
+    :params spectra: The spectra to modify
+    :type spectra: iterable of spectrum.Spectrum
+    :params operation: The method name, e.g. subtract, divide, normalize, process
+    :type operation: str
+    :returns: None
+    :raises: AssertionError
+
+    '''
+    assert operation in ('subtract', 'divide', 'normalize', 'clip_negative', 'average', 'process'), \
+        'Unknown operation: {}'.format(operation)
+
+    if operation == 'process':
+        threshold = kwargs.get('threshold', args[0] if args else None)
+        assert isinstance(threshold, int), 'Threshold must be of type int.'
+        spectra = list(spectra)
+        results = process_batch([spec.data for spec in spectra], threshold)
+        for spec, (spectrum2d, spectrum1d) in zip(spectra, results):
+            spec._set_processed(spectrum2d, spectrum1d, threshold)
+        return
+
+    for spec in spectra:
+        getattr(spec, operation)(*args, **kwargs)
 
 def write(spec, filename=None):
     '''Writes the spectrum object to file.
     
     '''
+    import pickle
     if not filename:
         filename = spec.name + '.pks'
     with open(filename, 'wb') as outf:
@@ -246,6 +546,7 @@ def load(filename):
     '''Loads the pickled spectrum object from file.
     
     '''
+    import pickle
     with open(filename, 'rb') as inf:
          spec = pickle.load(inf)
     return spec
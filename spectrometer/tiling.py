@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+'''
+Tiled grayscale conversion, thresholding and column reduction.
+
+Spectrum.process and Processor.process run three passes over the frame:
+grayscale conversion, masking with the threshold and the column sum.
+For large frames every pass streams the whole array through memory.
+threshold_reduce splits the frame into bands of tile_rows rows instead,
+which stay in the cpu cache for all three steps, and processes the bands
+on a thread pool (opencv and numpy release the GIL). The partial column
+sums of the bands are added at the end.
+
+Frames smaller than min_pixels are processed in one piece, where the
+thread overhead would dominate, as are all frames on single cpu machines.
+Floating point column sums may differ from the one piece result in the
+last digits, because the summation order differs.
+
+process_batch processes many stacks in parallel, one stack per task.
+
+'''
+import os
+
+import numpy as np
+
+
+TILE_ROWS = 64
+MIN_TILED_PIXELS = 2 ** 19
+
+# ITU-R BT.601 luma weights in BGR order, as used by cv2.COLOR_BGR2GRAY
+GRAY_WEIGHTS = np.array([0.114, 0.587, 0.299])
+
+# {max_workers: ThreadPoolExecutor}
+_pools = {}
+
+
+def threshold_reduce(data, threshold, tile_rows=TILE_ROWS, workers=None, min_pixels=MIN_TILED_PIXELS):
+    '''Returns the masked grayscale data and its column sums.
+
+    Equivalent to
+        gray = cv2.cvtColor(data, cv2.COLOR_BGR2GRAY)  # color data only
+        spectrum2d = np.where(gray >= threshold, gray, 0)
+        spectrum1d = np.sum(spectrum2d, axis=0)
+
+    :params data: The data of shape (rows, columns) or (rows, columns, 3)
+    :type data: numpy.ndarray
+    :params threshold: Values below threshold are set to zero
+    :type threshold: int
+    :params tile_rows: Number of rows per band
+    :type tile_rows: int
+    :params workers: Number of threads (default: number of cpus)
+    :type workers: int
+    :params min_pixels: Frames with less pixels are processed in one piece
+    :type min_pixels: int
+    :returns: spectrum2d (ndarray), spectrum1d (ndarray)
+    :raises: AssertionError
+
+    '''
+    assert data.ndim == 2 or (data.ndim == 3 and data.shape[2] == 3), 'data must be grayscale or BGR.'
+    assert tile_rows > 0, 'tile_rows must be positive.'
+
+    workers = workers or os.cpu_count() or 1
+    rows, columns = data.shape[:2]
+    spectrum2d = np.empty((rows, columns), dtype=_gray_dtype(data))
+    if workers == 1 or rows * columns < min_pixels or rows <= tile_rows:
+        return spectrum2d, _reduce_band(data, threshold, spectrum2d)
+
+    starts = range(0, rows, tile_rows)
+    bands = [(data[start:start + tile_rows], threshold, spectrum2d[start:start + tile_rows]) for start in starts]
+    partials = list(_pool(workers).map(lambda band: _reduce_band(*band), bands))
+    return spectrum2d, np.sum(partials, axis=0, dtype=partials[0].dtype)
+
+
+def process_batch(stacks, threshold, workers=None):
+    '''Processes many stacks in parallel, see threshold_reduce.
+
+    :params stacks: The data of the stacks
+    :type stacks: iterable of numpy.ndarray
+    :params threshold: Values below threshold are set to zero
+    :type threshold: int
+    :params workers: Number of threads (default: number of cpus)
+    :type workers: int
+    :returns: results (list): (spectrum2d, spectrum1d) per stack
+
+    '''
+    # One task per stack, tiling them as well would only add overhead
+    return list(_pool(workers).map(lambda data: threshold_reduce(data, threshold, min_pixels=np.inf), stacks))
+
+
+def _reduce_band(band, threshold, out):
+    '''Converts, masks and sums one band, the masked band is written to out.
+
+    :returns: column_sums (ndarray)
+
+    '''
+    gray = band if band.ndim == 2 else _to_gray(band)
+    out[...] = 0
+    np.copyto(out, gray, where=gray >= threshold)
+    return np.sum(out, axis=0)
+
+
+def _to_gray(band):
+    if band.dtype in (np.uint8, np.uint16, np.float32):
+        import cv2
+        return cv2.cvtColor(band, cv2.COLOR_BGR2GRAY)
+    # cvtColor does not support other types, e.g. float64 stacks
+    return np.dot(band, GRAY_WEIGHTS)
+
+
+def _gray_dtype(data):
+    if data.ndim == 2 or data.dtype in (np.uint8, np.uint16, np.float32):
+        return data.dtype
+    return np.result_type(data.dtype, GRAY_WEIGHTS.dtype)
+
+
+def _pool(workers):
+    '''Returns the shared thread pool with workers threads.
+
+    '''
+    workers = workers or os.cpu_count() or 1
+    if workers not in _pools:
+        import concurrent.futures
+        _pools[workers] = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='tiling')
+    return _pools[workers]
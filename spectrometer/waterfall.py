@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+'''
+Live waterfall (spectrogram) display of 1d spectra.
+
+Every new spectrum1d is downsampled to the display width and written as
+one row into a fixed size ring (Waterfall), so the memory does not grow
+with the length of the session. time_bin consecutive spectra are merged
+into one row, a ring of height rows shows height * time_bin spectra.
+
+Downsampling keeps the maximum of every group of columns, so narrow
+emission lines stay visible when 1920 columns are shown in 960 pixels.
+The groups differ in size by at most one column (see bin_starts).
+minmax_downsample also returns the minimum, e.g. for envelope plots.
+
+The view runs in its own thread and is fed from acquisition through a
+queue, spectra are dropped instead of slowing down the capture:
+
+    view = WaterfallView(Waterfall(width=1920))
+    view.start()
+    while measuring:
+        spectrum.process(threshold)
+        view.submit(spectrum.spectrum1d)
+    view.stop()
+
+Or in its own process from a frame bus publishing 1d spectra:
+
+    python waterfall.py spectrometer
+
+'''
+import queue
+import threading
+import time
+
+import numpy as np
+
+
+def bin_starts(length, bins):
+    '''Returns the start indices of bins groups of nearly equal size.
+
+    The group sizes differ by at most one column, so a length which is
+    not a multiple of bins is spread over all groups. Reduce the groups
+    with reduceat, which reduces from every start up to the next one.
+
+    :params length: The number of columns
+    :type length: int
+    :params bins: Number of groups (at most length)
+    :type bins: int
+    :returns: starts (ndarray of intp)
+    :raises: AssertionError
+
+    '''
+    assert 0 < bins <= length, 'bins must be between 1 and the data length.'
+    return np.linspace(0, length, bins, endpoint=False).astype(np.intp)
+
+
+def minmax_downsample(data, bins):
+    '''Returns the minimum and maximum of bins groups of the last axis, see bin_starts.
+
+    :params data: The data, e.g. a spectrum1d or a stack of spectra
+    :type data: numpy.ndarray
+    :params bins: Number of groups (at most the length of the last axis)
+    :type bins: int
+    :returns: minimum (ndarray), maximum (ndarray): shape data.shape[:-1] + (bins,)
+    :raises: AssertionError
+
+    '''
+    data = np.asarray(data)
+    starts = bin_starts(data.shape[-1], bins)
+    return np.minimum.reduceat(data, starts, axis=-1), np.maximum.reduceat(data, starts, axis=-1)
+
+
+class Waterfall(object):
+    '''Ring of downsampled spectra.
+
+    :params width: The length of the spectra
+    :type width: int
+    :params height: Number of rows in the ring
+    :type height: int
+    :params display_width: Number of columns of the rendered image
+    :type display_width: int
+    :params time_bin: Number of spectra merged (maximum) into one row
+    :type time_bin: int
+    :params levels: (low, high) values mapped to the ends of the colormap
+        (None: 1st and 99.9th percentile of the ring)
+    :type levels: tuple
+    :params log: If true show log(1 + value)
+    :type log: bool
+    :params count: Number of completed rows
+    :type count: int
+
+    '''
+
+    def __init__(self, width, height=512, display_width=960, time_bin=1, levels=None, log=False):
+        assert time_bin >= 1, 'time_bin must be at least 1.'
+
+        self.width = width
+        self.height = height
+        self.display_width = min(display_width, width)
+        self.time_bin = time_bin
+        self.levels = levels
+        self.log = log
+        self.count = 0
+        self.rows = np.zeros((height, self.display_width), dtype=np.float32)
+        self._pending = np.empty(self.display_width, dtype=np.float32)
+        self._merged = 0
+        self._starts = bin_starts(width, self.display_width)
+
+    def append(self, spectrum1d):
+        '''Adds a spectrum.
+
+        :params spectrum1d: The spectrum of length width
+        :type spectrum1d: numpy.ndarray
+        :returns: None
+        :raises: AssertionError
+
+        '''
+        assert len(spectrum1d) == self.width, 'spectrum1d must be of length {}.'.format(self.width)
+
+        # Only the maximum is shown, the minimum is not computed
+        maximum = np.maximum.reduceat(np.asarray(spectrum1d), self._starts)
+        if self._merged == 0:
+            self._pending[:] = maximum
+        else:
+            np.maximum(self._pending, maximum, out=self._pending)
+        self._merged += 1
+
+        if self._merged == self.time_bin:
+            self.rows[self.count % self.height] = self._pending
+            self.count += 1
+            self._merged = 0
+
+    def image(self):
+        '''Returns the rows in display order, newest row at the top.
+
+        :returns: image (ndarray of float32): shape (min(count, height), display_width)
+
+        '''
+        head = self.count % self.height
+        if self.count < self.height:
+            return self.rows[head - 1::-1] if head else self.rows[:0]
+        # Newest rows are before head, the oldest from head on
+        return np.concatenate((self.rows[head - 1::-1], self.rows[:head - 1:-1])) if head else self.rows[::-1]
+
+    def render(self, colormap='inferno'):
+        '''Renders the ring as a color image.
+
+        :params colormap: An opencv colormap name (inferno, viridis, jet, ...)
+        :type colormap: str
+        :returns: image (ndarray of uint8): BGR image of shape (height, display_width, 3)
+
+        '''
+        import cv2
+
+        image = np.zeros((self.height, self.display_width), dtype=np.float32)
+        rows = self.image()
+        image[:len(rows)] = np.log1p(np.maximum(rows, 0)) if self.log else rows
+
+        if self.levels is not None:
+            low, high = (np.log1p(level) for level in self.levels) if self.log else self.levels
+        elif len(rows):
+            low, high = np.percentile(image[:len(rows)], (1, 99.9))
+        else:
+            low, high = 0, 1
+        scale = 255 / (high - low) if high > low else 0
+        gray = cv2.convertScaleAbs(image, alpha=scale, beta=-low * scale)
+        return cv2.applyColorMap(gray, getattr(cv2, 'COLORMAP_' + colormap.upper()))
+
+
+class WaterfallView(threading.Thread):
+    '''Shows a waterfall in an opencv window, fed through a queue.
+
+    Rendering is limited to fps frames per second, all queued spectra are
+    added before every render. Close the window with q or call stop.
+
+    :params waterfall: The waterfall
+    :type waterfall: Waterfall
+    :params window: The window name
+    :type window: str
+    :params fps: Maximum number of renders per second
+    :type fps: float
+    :params maxsize: Maximum number of queued spectra, further spectra are dropped
+    :type maxsize: int
+    :params colormap: The colormap, see Waterfall.render
+    :type colormap: str
+    :params dropped: Number of dropped spectra
+    :type dropped: int
+
+    '''
+
+    def __init__(self, waterfall, window='waterfall', fps=20, maxsize=1024, colormap='inferno'):
+        threading.Thread.__init__(self, name='waterfall view', daemon=True)
+        self.waterfall = waterfall
+        self.window = window
+        self.fps = fps
+        self.colormap = colormap
+        self.spectra = queue.Queue(maxsize)
+        self.dropped = 0
+        self.running = threading.Event()
+        self.running.set()
+
+    def submit(self, spectrum1d):
+        '''Queues a spectrum without blocking.
+
+        :returns: queued (bool)
+
+        '''
+        try:
+            self.spectra.put_nowait(spectrum1d)
+        except queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def stop(self):
+        '''Stops the view and waits for its thread.
+
+        '''
+        self.running.clear()
+        if self.is_alive():
+            self.join()
+
+    def run(self):
+        import cv2
+
+        cv2.namedWindow(self.window)
+        while self.running.is_set():
+            start = time.time()
+            self._drain()
+            cv2.imshow(self.window, self.waterfall.render(self.colormap))
+
+            wait = max(1, int(1000 * (1 / self.fps - (time.time() - start))))
+            if cv2.waitKey(wait) & 0xFF == ord('q'):
+                break
+        self.running.clear()
+        cv2.destroyWindow(self.window)
+
+    def _drain(self):
+        while True:
+            try:
+                self.waterfall.append(self.spectra.get_nowait())
+            except queue.Empty:
+                return
+
+
+def view_bus(name, height=512, display_width=960, time_bin=1, fps=20, **kwargs):
+    '''Shows the 1d spectra published on a frame bus, blocks until the window is closed.
+
+    Run it in its own process, the bus frames must be 1d spectra.
+    Further keyword arguments are passed to Waterfall.
+
+    :params name: The frame bus name
+    :type name: str
+    :returns: None
+
+    '''
+    from framebus import FrameReader
+
+    reader = FrameReader(name)
+    waterfall = Waterfall(reader.shape[0], height, display_width, time_bin, **kwargs)
+    view = WaterfallView(waterfall, window=name, fps=fps)
+    view.start()
+    try:
+        while view.is_alive():
+            seq, spectrum1d, _ = reader.read(timeout=0.1, copy=True)
+            if seq is not None:
+                view.submit(spectrum1d)
+    finally:
+        view.stop()
+        reader.close()
+
+
+if __name__ == '__main__':
+    import sys
+    assert len(sys.argv) == 2, 'Usage: python waterfall.py bus_name'
+
+    view_bus(sys.argv[1])
@@ -0,0 +1,1118 @@
+# -*- coding: utf-8 -*-
+'''
+Run with: python -m pytest tests/tests.py (or python -m unittest tests.tests)
+
+The modules in spectrometer/ import each other by module name,
+so the package directory is put on sys.path.
+
+The regression tests compare processing results with golden outputs in
+tests/golden/. Inputs are synthetic captures from a seeded generator and
+spectrum.jpg. After an intended change of the results regenerate the
+golden files with:
+
+    REGENERATE_GOLDEN=1 python -m pytest tests/tests.py
+
+'''
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import os.path
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+import numpy as np
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+PACKAGE_DIR = os.path.join(TESTS_DIR, '..', 'spectrometer')
+GOLDEN_DIR = os.path.join(TESTS_DIR, 'golden')
+SPECTRUM_JPG = os.path.join(PACKAGE_DIR, 'spectrum.jpg')
+# The spectrum in the frames of the 1080p webcam (top, bottom, left, right)
+ROI_1080P = (300, 500, 1000, 1920)
+REGENERATE = os.environ.get('REGENERATE_GOLDEN') == '1'
+sys.path.insert(0, PACKAGE_DIR)
+
+
+def import_spectrometer():
+    '''Imports spectrometer/spectrometer.py by its file path.
+
+    A plain import spectrometer may find the package instead, depending on
+    sys.path and the name of the checkout directory.
+
+    :returns: module
+
+    '''
+    name = 'spectrometer_module'
+    if name not in sys.modules:
+        spec = importlib.util.spec_from_file_location(name, os.path.join(PACKAGE_DIR, 'spectrometer.py'))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        sys.modules[name] = module
+    return sys.modules[name]
+
+
+def import_in_subprocess(module):
+    '''Imports module in a fresh interpreter.
+
+    numpy is imported first, it is needed anyway and only the module's
+    own import time is measured.
+
+    :returns: elapsed (float): import time in seconds, modules (list): loaded module names
+
+    '''
+    code = '\n'.join([
+        'import json, sys, time',
+        'import numpy',
+        't = time.perf_counter()',
+        'import {}'.format(module),
+        'elapsed = time.perf_counter() - t',
+        'print(json.dumps([elapsed, sorted(sys.modules)]))',
+    ])
+    output = subprocess.check_output([sys.executable, '-c', code], cwd=PACKAGE_DIR)
+    return json.loads(output.decode())
+
+
+class TestImportTime(unittest.TestCase):
+    '''Importing the data handling modules must not load plotting, gui or serial libraries.
+
+    '''
+    # pickle is not checked, numpy already imports it.
+    # The import time itself is not asserted, it depends on the machine and its load.
+    deferred = ('cv2', 'matplotlib', 'serial')
+
+    def check(self, module, deferred):
+        elapsed, modules = import_in_subprocess(module)
+        for name in deferred:
+            self.assertNotIn(name, modules, '{} imports {}'.format(module, name))
+
+    def test_spectrum(self):
+        self.check('spectrum', self.deferred)
+
+    def test_processor(self):
+        self.check('processor', self.deferred)
+
+    def test_source(self):
+        self.check('source', self.deferred)
+
+    def test_spectrometer(self):
+        # The detector needs cv2 for the camera, serial is only loaded with a Source
+        elapsed, modules = import_in_subprocess('spectrometer')
+        self.assertNotIn('serial', modules)
+        self.assertNotIn('matplotlib', modules)
+
+
+def synthetic_frames(num_frames, shape=(60, 320), channels=3, bit_depth=8, seed=0):
+    '''Returns seeded synthetic captures of a line spectrum.
+
+    Three emission lines (one of them saturated) on a dark background with
+    gaussian noise, plus a hot pixel which is lit in every sixth frame from frame 5 on.
+
+    :returns: frames (list of ndarray): uint8 for 8 bit, uint16 otherwise
+
+    '''
+    rng = np.random.RandomState(seed)
+    rows, columns = shape
+    full_scale = 2 ** bit_depth - 1
+
+    x = np.arange(columns)
+    y = np.arange(rows)[:, np.newaxis]
+    profile = np.zeros(columns)
+    for center, width, height in ((60, 3.0, 0.4), (170, 2.0, 1.2), (250, 6.0, 0.15)):
+        profile += height * np.exp(-0.5 * ((x - center) / width) ** 2)
+    band = np.exp(-0.5 * ((y - rows / 2) / (rows / 6)) ** 2)
+    ideal = full_scale * band * profile + 0.02 * full_scale
+
+    dtype = np.uint8 if bit_depth == 8 else np.uint16
+    frames = []
+    for i in range(num_frames):
+        frame = ideal + rng.normal(0, 0.01 * full_scale, ideal.shape)
+        if i % 6 == 5:
+            frame[rows // 4, columns // 3] = full_scale
+        frame = np.clip(np.rint(frame), 0, full_scale).astype(dtype)
+        if channels == 3:
+            # Slightly different channels, so the grayscale conversion matters
+            frame = np.dstack((frame, frame // 2 + frame // 4, frame // 2))
+        frames.append(frame)
+    return frames
+
+
+class FakeCapture(object):
+    '''Stands in for cv2.VideoCapture and returns the given frames in a loop.
+
+    '''
+
+    def __init__(self, frames, shape=None):
+        import cv2
+        self.frames = frames
+        self.index = 0
+        # The frame size differs from the array shape for raw buffers
+        rows, columns = shape or frames[0].shape[:2]
+        self.props = {
+            cv2.CAP_PROP_FRAME_WIDTH: columns,
+            cv2.CAP_PROP_FRAME_HEIGHT: rows,
+        }
+
+    def isOpened(self):
+        return True
+
+    def open(self, device):
+        return True
+
+    def read(self):
+        frame = self.frames[self.index % len(self.frames)]
+        self.index += 1
+        return True, frame.copy()
+
+    def get(self, prop):
+        return self.props.get(prop, 0)
+
+    def set(self, prop, value):
+        self.props[prop] = value
+        return True
+
+    def release(self):
+        pass
+
+
+def fake_detector(frames, mode='bgr'):
+    from detector import Detector
+    from session import CaptureSession
+    return Detector(mode=mode, session=CaptureSession(0, cap=FakeCapture(frames)))
+
+
+class GoldenTestCase(unittest.TestCase):
+    '''Compares results with the golden files in tests/golden.
+
+    '''
+
+    def assertGolden(self, name, rtol=1e-6, atol=0.0, **arrays):
+        filename = os.path.join(GOLDEN_DIR, name + '.npz')
+        if REGENERATE:
+            if not os.path.isdir(GOLDEN_DIR):
+                os.makedirs(GOLDEN_DIR)
+            np.savez(filename, **arrays)
+            return
+
+        self.assertTrue(os.path.isfile(filename), 'Golden file {} missing, see module docstring.'.format(filename))
+        with np.load(filename) as golden:
+            self.assertEqual(sorted(golden.files), sorted(arrays))
+            for key, value in arrays.items():
+                self.assertEqual(golden[key].shape, np.shape(value), '{}: {}'.format(name, key))
+                np.testing.assert_allclose(value, golden[key], rtol=rtol, atol=atol, err_msg='{}: {}'.format(name, key))
+
+
+def stacked(frames, dtype=np.float32):
+    '''Returns a Spectrum of the plain sum of frames.
+
+    '''
+    from spectrum import Spectrum
+    from stacking import make_stack
+    stack = make_stack('sum', dtype=dtype)
+    for frame in frames:
+        stack.add(frame)
+    spec = Spectrum(kind='spectrum', name='synthetic', bit_depth=8 if frames[0].dtype == np.uint8 else 16)
+    spec.add_data(stack.result())
+    spec.num_frames = stack.count
+    return spec
+
+
+class TestSpectrumRegression(GoldenTestCase):
+    '''Spectrum.process and the in place arithmetic.
+
+    '''
+
+    def test_threshold_semantics(self):
+        # Values equal to the threshold are kept, values below are zeroed
+        from spectrum import Spectrum
+        spec = Spectrum(name='threshold')
+        spec.add_data(np.array([[9, 10, 11], [10, 0, 255]], dtype=np.uint8))
+        spec.process(10)
+        np.testing.assert_array_equal(spec.spectrum2d, [[0, 10, 11], [10, 0, 255]])
+        np.testing.assert_array_equal(spec.spectrum1d, [10, 10, 266])
+
+    def test_float32_sum_is_exact(self):
+        frames = synthetic_frames(32)
+        exact = np.sum(frames, axis=0, dtype=np.uint64)
+        np.testing.assert_array_equal(stacked(frames).data, exact)
+
+    def test_color_sum(self):
+        spec = stacked(synthetic_frames(16))
+        spec.process(40)
+        self.assertGolden('spectrum_color_sum', spectrum1d=spec.spectrum1d)
+
+    def test_mono16_sum(self):
+        spec = stacked(synthetic_frames(16, channels=1, bit_depth=16, seed=1))
+        spec.process(2000)
+        self.assertGolden('spectrum_mono16_sum', spectrum1d=spec.spectrum1d)
+
+    def test_load_images(self):
+        import cv2
+        from spectrum import Spectrum
+        tmp = tempfile.mkdtemp()
+        try:
+            bgra = os.path.join(tmp, 'bgra.png')
+            frame = synthetic_frames(1)[0]
+            cv2.imwrite(bgra, np.dstack((frame, np.full(frame.shape[:2], 255, np.uint8))))
+            gray16 = os.path.join(tmp, 'gray16.png')
+            cv2.imwrite(gray16, synthetic_frames(1, channels=1, bit_depth=16)[0])
+
+            spec = Spectrum(name='bgra')
+            spec.load(bgra)
+            self.assertEqual(spec.data.shape, (60, 320, 3))
+            spec.process(40)
+            spec = Spectrum(name='gray16')
+            spec.load(gray16)
+            self.assertEqual((spec.data.shape, spec.data.dtype), ((60, 320), np.uint16))
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_subtract_average(self):
+        spec = stacked(synthetic_frames(16, seed=2))
+        background = stacked([np.full_like(frame, 5) for frame in synthetic_frames(16, seed=3)])
+        spec.subtract(background)
+        spec.average()
+        spec.clip_negative()
+        spec.process(10)
+        self.assertGolden('spectrum_subtract_average', rtol=1e-5, spectrum1d=spec.spectrum1d)
+
+
+class TestProcessorRegression(GoldenTestCase):
+    '''Processor.load and Processor.process.
+
+    jpg decoding may differ slightly between libjpeg versions, hence the tolerance.
+
+    '''
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_jpg(self):
+        from processor import Processor
+        processor = Processor()
+        processor.load(SPECTRUM_JPG)
+        # 1920x1080 frames are cropped to the spectrum by default
+        processor.process(10)
+        self.assertEqual(processor.spectrum2d.shape, (200, 920))
+        self.assertGolden('processor_jpg', rtol=1e-2, atol=50, spectrum1d=processor.spectrum1d)
+
+    def test_jpg_gray_reduced(self):
+        from processor import Processor
+        processor = Processor()
+        processor.load(SPECTRUM_JPG, gray=True, reduce=2)
+        processor.process(10)
+        self.assertEqual(processor.spectrum2d.shape, (540, 960))
+        self.assertGolden('processor_jpg_gray_reduced', rtol=1e-2, atol=50, spectrum1d=processor.spectrum1d)
+
+    def test_reduced_roi(self):
+        from processor import Processor
+        processor = Processor()
+        processor.load(SPECTRUM_JPG, gray=True, reduce=2)
+        processor.process(10, ROI_1080P)
+        self.assertEqual(processor.spectrum2d.shape, (100, 460))
+
+        # Same region at half resolution, a quarter of the pixels
+        full = Processor()
+        full.load(SPECTRUM_JPG, gray=True)
+        full.process(10)
+        self.assertAlmostEqual(processor.spectrum1d.sum() / full.spectrum1d.sum(), 0.25, delta=0.02)
+
+    def test_load_roi(self):
+        from processor import Processor
+        whole = Processor()
+        whole.load(SPECTRUM_JPG, gray=True, reduce=2)
+        processor = Processor()
+        # The roi of load is in full resolution pixels as well, lists (e.g. from json) are accepted
+        processor.load(SPECTRUM_JPG, gray=True, reduce=2, roi=list(ROI_1080P))
+        processor.load(SPECTRUM_JPG, gray=True, reduce=2, roi=ROI_1080P)
+        np.testing.assert_array_equal(processor.data, whole.data[150:250, 500:960])
+        processor.process(10, (0, None, 0, None))
+        whole.process(10, ROI_1080P)
+        np.testing.assert_array_equal(processor.spectrum1d, whole.spectrum1d)
+
+    def test_png_alpha(self):
+        import cv2
+        from processor import Processor
+        frame = synthetic_frames(1)[0]
+        filename = os.path.join(self.tmp, 'bgra.png')
+        cv2.imwrite(filename, np.dstack((frame, np.full(frame.shape[:2], 255, np.uint8))))
+        processor = Processor()
+        processor.load(filename)
+        np.testing.assert_array_equal(processor.data, frame)
+        processor.process(40)
+
+    def test_disk_cache(self):
+        from processor import Processor, _image_cache
+        first = Processor(cache_dir=self.tmp)
+        first.load(SPECTRUM_JPG, gray=True)
+        _image_cache.clear()
+        second = Processor(cache_dir=self.tmp)
+        second.load(SPECTRUM_JPG, gray=True)
+        np.testing.assert_array_equal(first.data, second.data)
+
+    def test_npy_matches_spectrum(self):
+        spec = stacked(synthetic_frames(8, seed=4))
+        filename = os.path.join(self.tmp, 'synthetic.npy')
+        np.save(filename, spec.data)
+        spec.process(40)
+
+        from processor import Processor
+        processor = Processor()
+        processor.load(filename)
+        processor.process(40)
+        np.testing.assert_array_equal(processor.spectrum1d, spec.spectrum1d)
+
+
+class TestDetectorRegression(GoldenTestCase):
+    '''Detector measurements from a fake camera.
+
+    '''
+
+    def measure(self, mode='bgr', stack='sum', **kwargs):
+        frames = kwargs.pop('frames', None) or synthetic_frames(20)
+        detector = fake_detector(frames, mode)
+        return detector.measure_spectrum(20, 0, name='fake', stack=stack, **kwargs)
+
+    def test_stacks(self):
+        for stack in ('sum', 'sigma', 'median', 'minmax'):
+            with self.subTest(stack=stack):
+                spec = self.measure(stack=stack)
+                self.assertEqual(spec.num_frames, 20)
+                spec.process(40)
+                self.assertGolden('detector_{}'.format(stack), rtol=1e-5, spectrum1d=spec.spectrum1d)
+
+    def test_conditions(self):
+        start = time.time()
+        spec = self.measure()
+        self.assertTrue(start <= spec.timestamp <= time.time())
+        self.assertIsNotNone(spec.exposure)
+        self.assertIsNotNone(spec.gain)
+
+    def test_sigma_rejects_hot_pixel(self):
+        frames = synthetic_frames(20)
+        plain = self.measure(frames=frames)
+        clipped = self.measure(stack='sigma', frames=frames)
+        hot = (15, 106)
+        self.assertLess(clipped.data[hot].max(), plain.data[hot].max() / 2)
+
+    def test_sigma_matches_reference(self):
+        from stacking import make_stack
+
+        kappa, warmup, min_sigma = 3.0, 5, 1.0
+        for channels, bit_depth in ((3, 8), (1, 16)):
+            with self.subTest(bit_depth=bit_depth):
+                frames = synthetic_frames(16, channels=channels, bit_depth=bit_depth, seed=6)
+                # refresh=1 updates all limits with every frame
+                stack = make_stack('sigma', kappa=kappa, warmup=warmup, min_sigma=min_sigma, refresh=1)
+                total = sumsq = accepted = 0
+                for i, frame in enumerate(frames):
+                    stack.add(frame)
+                    frame = frame.astype(np.float64)
+                    if i < warmup:
+                        mask = 1
+                    else:
+                        mean = total / accepted
+                        std = np.sqrt(np.maximum(sumsq - total * mean, 0) / np.maximum(accepted - 1, 1))
+                        mask = np.abs(frame - mean) <= kappa * np.maximum(std, min_sigma)
+                    total = total + frame * mask
+                    sumsq = sumsq + frame ** 2 * mask
+                    accepted = accepted + mask
+                np.testing.assert_allclose(stack.result(), total / accepted * len(frames), rtol=1e-5)
+
+    def test_median_matches_numpy(self):
+        from stacking import make_stack
+
+        frames = synthetic_frames(11, seed=7)
+        stack = make_stack('median', chunk_size=4)
+        for frame in frames:
+            stack.add(frame)
+        # Two full chunks and a partial chunk of three frames
+        medians = [np.median(frames[start:start + 4], axis=0) * len(frames[start:start + 4]) for start in (0, 4, 8)]
+        np.testing.assert_allclose(stack.result(), np.sum(medians, axis=0), rtol=1e-6)
+
+    def test_mono(self):
+        spec = self.measure(mode='mono')
+        self.assertEqual(spec.data.ndim, 2)
+        spec.process(40)
+        self.assertGolden('detector_mono', rtol=1e-5, spectrum1d=spec.spectrum1d)
+
+    def test_y16(self):
+        frames = synthetic_frames(20, channels=1, bit_depth=16, seed=5)
+        spec = self.measure(mode='y16', frames=frames)
+        self.assertEqual(spec.bit_depth, 16)
+        spec.process(2000)
+        self.assertGolden('detector_y16', rtol=1e-5, spectrum1d=spec.spectrum1d)
+
+    def test_raw_buffer(self):
+        from detector import Detector
+        from session import CaptureSession
+        for mode, bit_depth in (('y10', 10), ('y16', 16)):
+            with self.subTest(mode=mode):
+                frames = synthetic_frames(20, channels=1, bit_depth=bit_depth, seed=5)
+                # Without the RGB conversion V4L returns the frames as 1xN byte buffers
+                raw = [frame.astype('<u2').view(np.uint8).reshape(1, -1) for frame in frames]
+                cap = FakeCapture(raw, shape=frames[0].shape)
+                detector = Detector(mode=mode, session=CaptureSession(0, cap=cap))
+                spec = detector.measure_spectrum(20, 0, name='raw')
+                np.testing.assert_array_equal(spec.data, np.sum(frames, axis=0))
+
+    def test_roi(self):
+        spec = self.measure(roi=(10, 50, 100, 300))
+        self.assertEqual(spec.data.shape, (40, 200, 3))
+        full = self.measure()
+        np.testing.assert_array_equal(spec.data, full.data[10:50, 100:300])
+
+    def test_saturation(self):
+        spec = self.measure()
+        # The hot pixel is lit in 3 of 20 frames, the strong line always saturates
+        self.assertEqual(spec.saturation[15, 106, 0], 3)
+        self.assertEqual(spec.saturation[30, 170, 0], 20)
+        spec.process(40)
+        self.assertGolden('detector_saturation', saturated1d=spec.saturated1d)
+
+    def test_adaptive_saturated_channel(self):
+        # Only the blue channel of the strong line saturates, not the grayscale
+        detector = fake_detector(synthetic_frames(8))
+        with contextlib.redirect_stdout(io.StringIO()):
+            spec = detector.measure_adaptive(1e9, 10, 0, name='fake', max_frames=8, roi=(20, 40, 150, 190))
+        self.assertEqual(spec.num_frames, 8)
+        self.assertTrue(spec.saturated)
+
+    def test_adaptive_dark_frames(self):
+        # All columns are zero, the snr must not become nan
+        detector = fake_detector([np.zeros((60, 320, 3), dtype=np.uint8)] * 4)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            spec = detector.measure_adaptive(10, 10, 0, name='dark', max_frames=6)
+        self.assertEqual(spec.snr, 0)
+        self.assertFalse(spec.saturated)
+        self.assertIn('below target', output.getvalue())
+
+    def test_shared_session_modes(self):
+        import cv2
+        from detector import Detector
+        mono = fake_detector(synthetic_frames(4), mode='mono')
+        cap = mono.cap
+        self.assertEqual(cap.get(cv2.CAP_PROP_CONVERT_RGB), 0)
+        bgr = Detector(mode='bgr', session=mono.session)
+        self.assertEqual((cap.get(cv2.CAP_PROP_FOURCC), cap.get(cv2.CAP_PROP_CONVERT_RGB)), (0, 1))
+        # Every measurement requests the format of its detector again
+        self.assertEqual(mono.measure_spectrum(2, 0, name='mono').data.ndim, 2)
+        self.assertEqual(cap.get(cv2.CAP_PROP_FOURCC), cv2.VideoWriter_fourcc(*'GREY'))
+        bgr.measure_spectrum(2, 0, name='bgr')
+        self.assertEqual(cap.get(cv2.CAP_PROP_CONVERT_RGB), 1)
+
+    def test_settle(self):
+        from session import CaptureSession
+        frames = [np.full((16, 16, 3), value, dtype=np.uint8) for value in (0, 100, 200, 200, 200, 200)]
+        session = CaptureSession(0, cap=FakeCapture(frames))
+        # The first of three stable frames counts toward stability
+        self.assertEqual(session.settle(10, stable_frames=3), 5)
+        self.assertTrue(session.settled)
+
+        session = CaptureSession(0, cap=FakeCapture(frames[2:]))
+        self.assertEqual(session.settle(3, stable_frames=3), 3)
+        self.assertTrue(session.settled)
+
+        session = CaptureSession(0, cap=FakeCapture(frames[2:]))
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            self.assertEqual(session.settle(2, stable_frames=3), 2)
+        self.assertFalse(session.settled)
+        self.assertIn('3 stable frames are needed', output.getvalue())
+
+    def test_line_scan(self):
+        detector = fake_detector(synthetic_frames(10), 'bgr')
+        spec = detector.measure_line_scan(10, 0, 6, name='scan')
+        self.assertEqual(spec.data.shape, (10, 320))
+        self.assertGolden('detector_line_scan', rtol=1e-5, data=spec.data)
+
+    def test_scan_keeps_dtype(self):
+        # 10 frames of 30 rows of 16 bit data exceed float32, the scans are float64
+        from hyperspectral import load_cube, scan
+        detector = fake_detector(synthetic_frames(10, channels=1, bit_depth=16), 'y16')
+        tmp = tempfile.mkdtemp()
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                writer = scan(detector, None, 2, 10, 0, 30, name=os.path.join(tmp, 'scan'))
+            writer.close()
+            cube = load_cube(writer.filename)
+            self.assertEqual((cube.shape, cube.dtype), ((2, 2, 320), np.float64))
+            exact = np.sum(synthetic_frames(10, channels=1, bit_depth=16), axis=0, dtype=np.uint64)
+            np.testing.assert_array_equal(cube[0], exact.reshape(2, 30, 320).sum(axis=1))
+            del cube
+        finally:
+            shutil.rmtree(tmp)
+
+
+class TestDarkLibrary(unittest.TestCase):
+    '''Dark frame selection, interpolation and subtraction.
+
+    '''
+
+    def setUp(self):
+        from dark import DarkLibrary
+        self.darks = DarkLibrary(cache_size=2)
+        # bias 4 + 0.1 counts per exposure unit, recorded as sums of 10 frames
+        for exposure in (100, 200, 400):
+            self.darks.add(np.full((4, 6), 10 * (4 + 0.1 * exposure)), exposure, 0, timestamp=1000, num_frames=10)
+
+    def test_interpolation(self):
+        np.testing.assert_allclose(self.darks.dark(300, 0), 34)
+        np.testing.assert_allclose(self.darks.dark(100, 0), 14)
+        # Linear extrapolation outside the recorded exposures
+        np.testing.assert_allclose(self.darks.dark(50, 0), 9)
+
+    def test_selection(self):
+        self.darks.add(np.full((4, 6), 100.0), 200, 0, timestamp=2000, temperature=40)
+        self.darks.add(np.full((4, 6), 50.0), 200, 8, timestamp=1000)
+        np.testing.assert_allclose(self.darks.dark(200, 0, timestamp=1000), 24)
+        np.testing.assert_allclose(self.darks.dark(200, 0, timestamp=1000, temperature=35), 100)
+        np.testing.assert_allclose(self.darks.dark(200, 7), 50)
+
+    def test_cache(self):
+        dark = self.darks.dark(300, 0)
+        self.assertIs(self.darks.dark(300, 0), dark)
+        self.assertFalse(dark.flags.writeable)
+        self.darks.dark(150, 0)
+        self.darks.dark(250, 0)
+        self.assertEqual(len(self.darks._cache), 2)
+        self.assertIsNot(self.darks.dark(300, 0), dark)
+
+    def test_save_load(self):
+        from dark import DarkLibrary
+        tmp = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmp, 'darks.npz')
+            self.darks.save(filename)
+            loaded = DarkLibrary.load(filename)
+        finally:
+            shutil.rmtree(tmp)
+        self.assertEqual(len(loaded), 3)
+        np.testing.assert_allclose(loaded.dark(300, 0), self.darks.dark(300, 0))
+
+    def test_subtract_dark(self):
+        from dark import DarkLibrary
+        darks = DarkLibrary()
+        frames = [np.full((10, 20, 3), 6, dtype=np.uint8)]
+        detector = fake_detector(frames)
+        darks.record(detector, exposures=(100, 300), gain=2, num_frames=4, num_dropped_frames=0)
+
+        detector.pin(exposure=200, gain=2)
+        spec = detector.measure_spectrum(5, 0, name='spectrum')
+        self.assertEqual((spec.exposure, spec.gain), (200, 2))
+        spec.subtract_dark(darks)
+        np.testing.assert_allclose(spec.data, 0)
+
+
+class TestTiling(unittest.TestCase):
+    '''Tiled processing must match processing in one piece.
+
+    '''
+
+    def test_tiled_matches_one_piece(self):
+        from tiling import threshold_reduce
+        data = stacked(synthetic_frames(8, shape=(100, 320), seed=6)).data
+        for frame in (data, data.astype(np.float64), synthetic_frames(1, shape=(100, 320))[0]):
+            with self.subTest(dtype=frame.dtype):
+                whole2d, whole1d = threshold_reduce(frame, 40, workers=1)
+                tiled2d, tiled1d = threshold_reduce(frame, 40, tile_rows=7, workers=4, min_pixels=0)
+                np.testing.assert_array_equal(tiled2d, whole2d)
+                np.testing.assert_allclose(tiled1d, whole1d, rtol=1e-6)
+                self.assertEqual(tiled1d.dtype, whole1d.dtype)
+
+    def test_float64_matches_cv2(self):
+        from tiling import threshold_reduce
+        data = stacked(synthetic_frames(8, seed=7)).data
+        spectrum1d = threshold_reduce(data.astype(np.float64), 40)[1]
+        np.testing.assert_allclose(spectrum1d, threshold_reduce(data, 40)[1], rtol=1e-5)
+
+    def test_batch_process(self):
+        from spectrum import batch
+        spectra = [stacked(synthetic_frames(4, seed=seed)) for seed in range(3)]
+        batch(spectra, 'process', 40)
+        for spec in spectra:
+            expected = spec.spectrum1d
+            spec.process(40)
+            np.testing.assert_array_equal(spec.spectrum1d, expected)
+
+
+class TestPeaks(unittest.TestCase):
+    '''Peak search, line fits and tracking on synthetic lines.
+
+    '''
+
+    x = np.arange(200, dtype=np.float64)
+
+    def gaussian(self, center, fwhm, amplitude=1000.0):
+        sigma = fwhm / (2 * np.sqrt(2 * np.log(2)))
+        return amplitude * np.exp(-0.5 * ((self.x - center) / sigma) ** 2)
+
+    def lorentzian(self, center, fwhm, amplitude=1000.0):
+        return amplitude / (1 + ((self.x - center) / (fwhm / 2)) ** 2)
+
+    def test_find_peaks(self):
+        from peaks import find_peaks
+        spectrum1d = 10 + self.gaussian(50, 4) + self.gaussian(120, 6, 500)
+        np.testing.assert_array_equal(find_peaks(spectrum1d, threshold=100, distance=5), [50, 120])
+
+    def test_flat_start_is_no_peak(self):
+        from peaks import find_peaks
+        spectrum1d = self.gaussian(100, 5)
+        spectrum1d[:20] = 0
+        np.testing.assert_array_equal(find_peaks(spectrum1d, distance=20), [100])
+
+    def test_fit_profiles(self):
+        from peaks import fit_peaks
+        # Lorentzian wings are long, the window must be wider for the edge baseline
+        for profile, line, half_width in (('gaussian', self.gaussian, 10), ('lorentzian', self.lorentzian, 20)):
+            with self.subTest(profile=profile):
+                spectrum1d = line(80.3, 5.0)
+                amplitude, center, fwhm = fit_peaks(spectrum1d, [80], half_width=half_width, profile=profile)
+                self.assertAlmostEqual(center[0], 80.3, delta=0.02)
+                self.assertAlmostEqual(fwhm[0], 5.0, delta=0.3)
+
+    def test_tracker(self):
+        from peaks import PeakTracker
+        tracker = PeakTracker([60, 140], half_width=10)
+        for shift in np.linspace(0, 6, 13):
+            spectrum1d = self.gaussian(60 + shift, 5) + self.gaussian(140 - shift, 5)
+            _, center, _ = tracker.update(spectrum1d)
+        np.testing.assert_allclose(center, [66, 134], atol=0.02)
+
+
+class TestArchive(unittest.TestCase):
+    '''Chunked archive writing and time range queries.
+
+    '''
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'archive')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_query_across_chunks(self):
+        from archive import Archive
+        with Archive(self.path, chunk_size=4) as archive:
+            for i in range(10):
+                archive.append(np.full(8, i, dtype=np.float32), timestamp=100 + i, name='s{}'.format(i))
+            self.assertEqual(len(archive.chunks), 2)
+            # Records from both chunks and the unwritten buffer
+            timestamps, spectra, metadata = archive.query(102, 108)
+        np.testing.assert_array_equal(timestamps, np.arange(102, 109))
+        np.testing.assert_array_equal(spectra[:, 0], np.arange(2, 9))
+        self.assertEqual([item['name'] for item in metadata], ['s{}'.format(i) for i in range(2, 9)])
+        self.assertEqual(sorted(os.listdir(self.path)), ['chunk_000000.npz', 'chunk_000001.npz',
+                                                         'chunk_000002.npz', 'index.json'])
+
+    def test_reader_sees_new_chunks(self):
+        from archive import Archive
+        writer = Archive(self.path, chunk_size=2)
+        writer.append(np.zeros(4), timestamp=1)
+        writer.flush()
+        reader = Archive(self.path, mode='r')
+        self.assertEqual(len(reader.query()[0]), 1)
+
+        writer.append(np.ones(4), timestamp=2)
+        writer.append(np.ones(4), timestamp=3)
+        timestamps, spectra, _ = reader.query(start=2)
+        np.testing.assert_array_equal(timestamps, [2, 3])
+        writer.close()
+
+    def test_frames_and_empty_query(self):
+        from archive import Archive
+        with Archive(self.path, store_frames=True) as archive:
+            archive.append(np.zeros(4), timestamp=5, frame=np.ones((2, 4)))
+            timestamps, spectra, metadata, frames = archive.query(start=10)
+            self.assertEqual(len(timestamps), 0)
+            frames = archive.query()[3]
+        self.assertEqual(frames.shape, (1, 2, 4))
+        with self.assertRaises(AssertionError):
+            Archive(self.path, mode='r').append(np.zeros(4))
+
+
+class FakeDetector(object):
+    '''Stands in for the camera, every frame is the same line image.
+
+    '''
+    def __init__(self, frame):
+        self.frame = frame
+
+    def measure_background(self, num_frames, num_dropped_frames, name='background'):
+        return self._spectrum('background', num_frames, name)
+
+    def measure_spectrum(self, num_frames, num_dropped_frames, name='spectrum'):
+        return self._spectrum('spectrum', num_frames, name)
+
+    def _spectrum(self, kind, num_frames, name):
+        from spectrum import Spectrum
+        spec = Spectrum(kind=kind, name=name)
+        spec.add_data(self.frame.astype(np.float32) * num_frames)
+        spec.num_frames = num_frames
+        return spec
+
+
+class TestService(unittest.TestCase):
+    '''Json round trips against a service with a fake camera.
+
+    '''
+
+    def setUp(self):
+        import threading
+        from service import Client, Service
+        Spectrometer = import_spectrometer().Spectrometer
+
+        x = np.arange(320)
+        line = 200 * np.exp(-0.5 * ((x - 170) / 2.0) ** 2)
+        frame = np.repeat(np.tile(line, (60, 1))[:, :, np.newaxis], 3, axis=2).astype(np.uint8)
+        self.detector = FakeDetector(frame)
+
+        # Without init_components, no light source is connected
+        spectrometer = Spectrometer.__new__(Spectrometer)
+        spectrometer.detector = self.detector
+        self.service = Service(spectrometer, port=0)
+        self.thread = threading.Thread(target=self.service.serve_forever)
+        self.thread.start()
+        self.client = Client(port=self.service.server.server_address[1])
+
+    def tearDown(self):
+        self.client.shutdown()
+        self.client.close()
+        self.thread.join(5)
+
+    def test_ping(self):
+        self.assertEqual(self.client.ping(), {'status': 'ok'})
+
+    def test_measure(self):
+        reply = self.client.measure(4, 0, name='sample', threshold=40)
+        self.assertEqual((reply['name'], reply['kind'], reply['num_frames']), ('sample', 'spectrum', 4))
+        spec = self.detector.measure_spectrum(4, 0, name='sample')
+        spec.process(40)
+        np.testing.assert_allclose(reply['spectrum1d'], spec.spectrum1d)
+
+    def test_errors(self):
+        with self.assertRaises(RuntimeError):
+            self.client.request('unknown')
+        with self.assertRaises(RuntimeError):
+            self.client.measure(4, 0, kind='dark')
+        # The worker keeps running after errors
+        self.assertEqual(self.client.ping(), {'status': 'ok'})
+
+
+class TestFrameBus(unittest.TestCase):
+    '''Ring buffer policies, reader and publisher in one process.
+
+    '''
+
+    def setUp(self):
+        self.name = 'spectrometer_test_{}'.format(os.getpid())
+
+    def test_overwrite_drops_oldest(self):
+        from framebus import FrameBus, FrameReader
+        bus = FrameBus(self.name, shape=(4,), dtype=np.float32, slots=3)
+        reader = FrameReader(self.name, start='oldest')
+        try:
+            for i in range(5):
+                self.assertEqual(bus.publish(np.full(4, i), timestamp=i), i)
+            seq, frame, timestamp = reader.read(timeout=0, copy=True)
+            self.assertEqual((seq, timestamp, reader.dropped), (2, 2.0, 2))
+            np.testing.assert_array_equal(frame, 2)
+            self.assertEqual([reader.read(timeout=0)[0] for i in range(3)], [3, 4, None])
+        finally:
+            reader.close()
+            bus.close()
+
+    def test_block_waits_for_readers(self):
+        from framebus import FrameBus, FrameReader
+        bus = FrameBus(self.name, shape=(2, 2), dtype=np.uint16, slots=2, policy='block')
+        reader = FrameReader(self.name)
+        try:
+            self.assertEqual(bus.publish(np.zeros((2, 2))), 0)
+            self.assertEqual(bus.publish(np.ones((2, 2))), 1)
+            # The ring is full until the reader releases frame 0
+            self.assertIsNone(bus.publish(np.ones((2, 2)), timeout=0.01))
+            self.assertEqual(reader.read(timeout=0)[0], 0)
+            self.assertEqual(reader.read(timeout=0)[0], 1)
+            self.assertEqual(bus.publish(np.full((2, 2), 2), timeout=0.01), 2)
+            self.assertEqual(reader.dropped, 0)
+        finally:
+            reader.close()
+            bus.close()
+
+    @unittest.skipUnless(os.name == 'posix', 'Ended readers are only detected on posix systems')
+    def test_block_drops_ended_readers(self):
+        import framebus
+        bus = framebus.FrameBus(self.name, shape=(2,), dtype=np.uint8, slots=1, policy='block')
+        reader = framebus.FrameReader(self.name)
+        try:
+            self.assertEqual(bus.publish(np.zeros(2)), 0)
+            # Pretend the reader belongs to a process which ended without releasing frame 0
+            process = subprocess.Popen([sys.executable, '-c', 'pass'])
+            process.wait()
+            bus.header[framebus._PIDS + reader.index] = process.pid
+            self.assertEqual(bus.publish(np.ones(2), timeout=5), 1)
+        finally:
+            reader.close()
+            bus.close()
+
+    def test_closed_bus(self):
+        from framebus import FrameBus, FrameReader
+        bus = FrameBus(self.name, shape=(3,), dtype=np.float64)
+        reader = FrameReader(self.name)
+        bus.close()
+        self.assertEqual(reader.read(timeout=0), (None, None, None))
+        reader.close()
+
+
+class TestWaterfall(unittest.TestCase):
+    '''Downsampling and the ring of the waterfall.
+
+    '''
+
+    def test_uneven_width(self):
+        from waterfall import minmax_downsample, Waterfall
+        spectrum1d = np.zeros(1280, dtype=np.float32)
+        spectrum1d[1000] = 1
+        waterfall = Waterfall(1280, height=4, display_width=960)
+        waterfall.append(spectrum1d)
+        self.assertEqual(np.argmax(waterfall.image()[0]), 750)
+
+        minimum, maximum = minmax_downsample(np.arange(1280), 960)
+        np.testing.assert_array_equal(np.unique(maximum - minimum), [0, 1])
+
+    def test_ring(self):
+        from waterfall import Waterfall
+        waterfall = Waterfall(8, height=3, display_width=8, time_bin=2)
+        for i in range(8):
+            waterfall.append(np.full(8, i))
+        # Maximum of every pair, the newest 3 rows first
+        self.assertEqual(waterfall.count, 4)
+        np.testing.assert_array_equal(waterfall.image()[:, 0], [7, 5, 3])
+
+
+class TestLibrary(unittest.TestCase):
+    '''Reference matching and the index cache.
+
+    '''
+
+    def setUp(self):
+        from library import Library
+        x = np.arange(100)
+        self.references = {name: np.exp(-0.5 * ((x - center) / 4.0) ** 2)
+                           for name, center in (('a', 20), ('b', 50), ('c', 80))}
+        self.library = Library()
+        for name, spectrum1d in self.references.items():
+            self.library.add(name, spectrum1d)
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_match_order(self):
+        self.library.build()
+        query = self.references['b'] + 0.5 * self.references['c'] + 0.1 * self.references['a']
+        for method in ('cosine', 'correlation'):
+            with self.subTest(method=method):
+                names, scores = self.library.match(np.stack([query, self.references['a']]), method, k=3)
+                self.assertEqual(names[0], ['b', 'c', 'a'])
+                self.assertEqual(names[1][0], 'a')
+                self.assertTrue(np.all(np.diff(scores, axis=1) <= 0))
+
+    def test_unmix(self):
+        self.library.build()
+        query = 2 * self.references['a'] + 0.5 * self.references['c']
+        np.testing.assert_allclose(self.library.unmix(query)[0], [2, 0, 0.5], atol=1e-4)
+
+    def test_cache_checksum(self):
+        from library import Library
+        cache = os.path.join(self.tmp, 'index.npz')
+        self.library.build(cache)
+        # A valid cache is loaded as is, marked here to detect its use
+        with np.load(cache) as npz:
+            arrays = dict(npz)
+        arrays['cosine'] = np.zeros_like(arrays['cosine'])
+        np.savez(cache, **arrays)
+        self.library.build(cache)
+        np.testing.assert_array_equal(self.library._index['cosine'], 0)
+
+        # Different references must not use the cache
+        other = Library()
+        for name, spectrum1d in self.references.items():
+            other.add(name, 2 * spectrum1d)
+        other.build(cache)
+        self.assertTrue(np.all(other._index['cosine'].max(axis=1) > 0))
+
+    def test_save_load(self):
+        from library import Library
+        filename = os.path.join(self.tmp, 'library.npz')
+        self.library.save(filename)
+        loaded = Library.load(filename)
+        self.assertEqual(loaded.names, ['a', 'b', 'c'])
+        self.assertEqual(loaded.match(self.references['c'])[0], [['c']])
+
+
+class TestSpectrumProcess(unittest.TestCase):
+    '''Grayscale conversion of color stacks.
+
+    '''
+
+    def test_float64_color(self):
+        from spectrum import Spectrum
+        rng = np.random.RandomState(0)
+        data = rng.uniform(0, 255 * 2 ** 17, (20, 30, 3))
+        spectra = []
+        for dtype in (np.float32, np.float64):
+            spec = Spectrum()
+            spec.add_data(data.astype(dtype))
+            spec.process(10)
+            spectra.append(spec.spectrum1d)
+        np.testing.assert_allclose(spectra[1], spectra[0], rtol=1e-5)
+
+
+class TestSpectrumCollection(unittest.TestCase):
+    '''Columnar storage, selection and aggregation.
+
+    '''
+
+    def setUp(self):
+        from collection import SpectrumCollection
+        # Small capacity, so appending has to grow the arrays
+        self.collection = SpectrumCollection(4, capacity=2)
+        for i in range(10):
+            self.collection.append(np.full(4, i), 'n{}'.format(i % 2), 'spectrum' if i % 2 else 'background',
+                                   num_frames=i + 1, timestamp=100 + i)
+
+    def test_grow(self):
+        self.assertEqual(len(self.collection), 10)
+        self.assertGreaterEqual(len(self.collection._spectra), 10)
+        record = self.collection[-1]
+        self.assertEqual((record.name, record.kind, record.num_frames, record.timestamp), ('n1', 'spectrum', 10, 109))
+        np.testing.assert_array_equal(self.collection.spectra[:, 0], np.arange(10))
+
+    def test_filter_take(self):
+        selected = self.collection.filter(kind='spectrum', start=103, end=108)
+        np.testing.assert_array_equal(selected.timestamps, [103, 105, 107])
+        np.testing.assert_array_equal(selected.mean(), 5)
+        np.testing.assert_array_equal(self.collection[2:4].num_frames, [3, 4])
+        np.testing.assert_array_equal(self.collection.take(np.array([9, 0])).spectra[:, 0], [9, 0])
+        np.testing.assert_allclose(self.collection[1:3].mean(per_frame=True), (1 / 2 + 2 / 3) / 2)
+        self.assertEqual(sorted(self.collection.group_mean('kind')), ['background', 'spectrum'])
+
+    def test_append_spectrum(self):
+        from spectrum import Spectrum
+        spec = Spectrum(name='processed', kind='spectrum')
+        spec.add_data(np.ones((2, 4)))
+        spec.num_frames = 1
+        spec.process(0)
+        index = self.collection.append_spectrum(spec)
+        self.assertEqual(self.collection[index].name, 'processed')
+        np.testing.assert_array_equal(self.collection[index].spectrum1d, 2)
+
+    def test_save_load(self):
+        from collection import SpectrumCollection
+        # Missing names and kinds must stay None, not become the string 'None'
+        self.collection.append(np.zeros(4))
+        tmp = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmp, 'collection.npz')
+            self.collection.save(filename)
+            loaded = SpectrumCollection.load(filename)
+        finally:
+            shutil.rmtree(tmp)
+        np.testing.assert_array_equal(loaded.spectra, self.collection.spectra)
+        np.testing.assert_array_equal(loaded.timestamps, self.collection.timestamps)
+        self.assertEqual(list(loaded.kinds), list(self.collection.kinds))
+        self.assertEqual(list(loaded.names), list(self.collection.names))
+        self.assertEqual((loaded[-1].name, loaded[-1].kind), (None, None))
+        self.assertEqual(len(loaded.filter(name='n0')), 5)
+
+
+class FakeSource(object):
+    '''Records the switching of a light source.
+
+    '''
+
+    def __init__(self, broken=False):
+        self.states = []
+        self.broken = broken
+
+    def on(self):
+        self.states.append('on')
+
+    def off(self):
+        if self.broken:
+            raise OSError('port closed')
+        self.states.append('off')
+
+
+class TestExperiment(unittest.TestCase):
+    '''Experiment runs with a fake camera and light source.
+
+    '''
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def run_experiment(self, steps, repeat=3, frames=None, source=None):
+        from experiment import Experiment
+        experiment = Experiment({'name': 'test', 'path': self.tmp, 'source': 'fake', 'repeat': repeat,
+                                 'defaults': {'num_dropped_frames': 0, 'threshold': 10, 'formats': ['.csv']},
+                                 'steps': steps})
+        source = source or FakeSource()
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            try:
+                experiment.run(fake_detector(frames or synthetic_frames(6)), source)
+            finally:
+                self.output = output.getvalue()
+                with open(os.path.join(experiment.path, 'log.json')) as inf:
+                    self.saved = json.load(inf)
+        return experiment, source
+
+    def test_subtract_different_num_frames(self):
+        experiment, source = self.run_experiment([
+            {'kind': 'background', 'name': 'background', 'num_frames': 3, 'source': 'off'},
+            {'name': 'sample', 'num_frames': 6, 'source': 'on', 'subtract': 'background'},
+        ], frames=synthetic_frames(1))
+        self.assertEqual(len(experiment.log), 6)
+        self.assertEqual(self.saved, experiment.log)
+        self.assertEqual([entry['subtracted'] for entry in experiment.log[1::2]], ['background_0000',
+                                                                                  'background_0001',
+                                                                                  'background_0002'])
+        self.assertEqual(source.states[-1], 'off')
+        # Always the same frame, the background scaled to 6 frames cancels the sample
+        self.assertEqual(experiment.latest['sample'].spectrum1d.max(), 0)
+
+    def test_failing_step(self):
+        # The second step can not be processed, the first is logged and the source switched off
+        with self.assertRaises(AssertionError):
+            experiment, source = self.run_experiment([
+                {'kind': 'background', 'name': 'background', 'num_frames': 2},
+                {'name': 'sample', 'num_frames': 2, 'source': 'on', 'threshold': 'high'},
+            ], repeat=1)
+        self.assertEqual([entry['name'] for entry in self.saved], ['background_0000'])
+
+    def test_source_off_fails(self):
+        # The log is written first, the error of the source is only reported
+        experiment, source = self.run_experiment([
+            {'kind': 'background', 'name': 'background', 'num_frames': 2},
+        ], repeat=2, source=FakeSource(broken=True))
+        self.assertEqual(self.saved, experiment.log)
+        self.assertEqual(len(self.saved), 2)
+        self.assertIn('Could not switch off the light source: port closed', self.output)
+
+
+if __name__ == '__main__':
+    unittest.main()